@@ -0,0 +1,464 @@
+"""In-memory stand-in for google.cloud.firestore.Client.
+
+Implements the subset of the client API that main.py uses (documents,
+queries with where/order_by/start_after/select/limit, count aggregations,
+get_all, batches, transactions and field transforms) so the app can run and
+be measured without a Firestore project. Every round trip is counted in
+``client.calls`` and can be given an artificial latency to model the network.
+
+This is a benchmarking aid, not a faithful emulator: there are no indexes to
+declare, no contention between transactions beyond a global lock, and no
+size limits.
+"""
+import copy
+import threading
+import time
+import uuid
+from collections import defaultdict
+from datetime import datetime, timezone
+
+from google.api_core.exceptions import AlreadyExists, NotFound
+from google.cloud.firestore_v1 import transforms
+from google.cloud.firestore_v1.transforms import ArrayRemove, ArrayUnion, Increment
+
+DESCENDING = "DESCENDING"
+_MISSING = object()
+
+
+def _sort_key(value):
+    """Order values the way Firestore orders mixed types: null, numbers, then strings"""
+    if value is None or value is _MISSING:
+        return (0, 0)
+    if isinstance(value, bool):
+        return (1, value)
+    if isinstance(value, (int, float)):
+        return (2, value)
+    if isinstance(value, datetime):
+        return (3, value.timestamp())
+    if isinstance(value, str):
+        return (4, value)
+    return (5, str(value))
+
+
+class DocumentSnapshot:
+    def __init__(self, reference, data, field_paths=None):
+        self.reference = reference
+        self.id = reference.id
+        if data is not None and field_paths is not None:
+            data = {key: value for key, value in data.items() if key in field_paths}
+        self._data = data
+
+    @property
+    def exists(self):
+        return self._data is not None
+
+    def to_dict(self):
+        return copy.deepcopy(self._data) if self._data is not None else None
+
+    def get(self, field_path):
+        value = self._data or {}
+        for part in field_path.split("."):
+            value = value[part]
+        return copy.deepcopy(value)
+
+
+class DocumentReference:
+    def __init__(self, client, collection_path, doc_id):
+        self._client = client
+        self._collection_path = collection_path
+        self.id = doc_id
+        self.path = f"{collection_path}/{doc_id}"
+
+    def collection(self, name):
+        return CollectionReference(self._client, f"{self.path}/{name}")
+
+    def get(self, field_paths=None, transaction=None):
+        self._client._round_trip(reads=1)
+        return DocumentSnapshot(self, self._client._read(self), field_paths)
+
+    def set(self, data, merge=False):
+        self._client.batch().set(self, data, merge=merge).commit()
+
+    def update(self, data):
+        self._client.batch().update(self, data).commit()
+
+    def create(self, data):
+        self._client.batch().create(self, data).commit()
+
+    def delete(self, option=None):
+        self._client.batch().delete(self, option=option).commit()
+
+    def __eq__(self, other):
+        return isinstance(other, DocumentReference) and other.path == self.path
+
+    def __hash__(self):
+        return hash(self.path)
+
+
+class AggregationResult:
+    def __init__(self, alias, value):
+        self.alias = alias
+        self.value = value
+
+
+class CountQuery:
+    def __init__(self, query, alias):
+        self._query = query
+        self._alias = alias or "count"
+
+    def get(self, transaction=None):
+        count = len(self._query._matching_rows())
+        self._query._client._round_trip(reads=max(1, count // 1000))
+        return [[AggregationResult(self._alias, count)]]
+
+
+class Query:
+    def __init__(self, client, collection_path, filters=(), orders=(), limit=None, start_after=None, fields=None):
+        self._client = client
+        self._collection_path = collection_path
+        self._filters = tuple(filters)
+        self._orders = tuple(orders)
+        self._limit = limit
+        self._start_after = start_after
+        self._fields = fields
+
+    def _copy(self, **changes):
+        state = {
+            "filters": self._filters,
+            "orders": self._orders,
+            "limit": self._limit,
+            "start_after": self._start_after,
+            "fields": self._fields,
+        }
+        state.update(changes)
+        return Query(self._client, self._collection_path, **state)
+
+    def where(self, field_path=None, op_string=None, value=None, filter=None):
+        if filter is not None:
+            field_path, op_string, value = filter.field_path, filter.op_string, filter.value
+        return self._copy(filters=self._filters + ((field_path, op_string, value),))
+
+    def order_by(self, field_path, direction="ASCENDING"):
+        return self._copy(orders=self._orders + ((field_path, direction),))
+
+    def limit(self, count):
+        return self._copy(limit=count)
+
+    def start_after(self, document_fields):
+        return self._copy(start_after=document_fields)
+
+    def select(self, field_paths):
+        return self._copy(fields=list(field_paths))
+
+    def count(self, alias=None):
+        return CountQuery(self, alias)
+
+    def _matches(self, doc_id, data):
+        for field_path, op, expected in self._filters:
+            value = doc_id if field_path == "__name__" else data.get(field_path, _MISSING)
+            if op == "==":
+                if value != expected:
+                    return False
+            elif op == "in":
+                if value not in expected:
+                    return False
+            elif op == "array_contains":
+                if value is _MISSING or expected not in (value or []):
+                    return False
+            elif op in ("<", "<=", ">", ">="):
+                if value is _MISSING or _sort_key(value)[0] != _sort_key(expected)[0]:
+                    return False
+                if op == "<" and not value < expected:
+                    return False
+                if op == "<=" and not value <= expected:
+                    return False
+                if op == ">" and not value > expected:
+                    return False
+                if op == ">=" and not value >= expected:
+                    return False
+            else:
+                raise NotImplementedError(f"Unsupported operator {op}")
+        return True
+
+    def _order_value(self, doc_id, data, field_path):
+        return doc_id if field_path == "__name__" else data.get(field_path, _MISSING)
+
+    def _matching_rows(self):
+        rows = [
+            (doc_id, data) for doc_id, data in self._client._candidates(self._collection_path, self._filters)
+            if self._matches(doc_id, data)
+        ]
+        # Firestore leaves out documents missing an ordered field
+        for field_path, _ in self._orders:
+            if field_path != "__name__":
+                rows = [row for row in rows if field_path in row[1]]
+
+        orders = list(self._orders)
+        if not any(field_path == "__name__" for field_path, _ in orders):
+            orders.append(("__name__", orders[-1][1] if orders else "ASCENDING"))
+        for field_path, direction in reversed(orders):
+            rows.sort(key=lambda row: _sort_key(self._order_value(row[0], row[1], field_path)), reverse=direction == DESCENDING)
+
+        if self._start_after is not None:
+            if isinstance(self._start_after, DocumentSnapshot):
+                cursor = [
+                    self._start_after.id if field_path == "__name__" else self._start_after._data.get(field_path)
+                    for field_path, _ in orders
+                ]
+            else:
+                cursor = [self._start_after.get(field_path) for field_path, _ in orders]
+
+            def is_after(row):
+                for (field_path, direction), cursor_value in zip(orders, cursor):
+                    value = _sort_key(self._order_value(row[0], row[1], field_path))
+                    cursor_key = _sort_key(cursor_value)
+                    if value == cursor_key:
+                        continue
+                    return value < cursor_key if direction == DESCENDING else value > cursor_key
+                return False
+
+            rows = [row for row in rows if is_after(row)]
+
+        if self._limit is not None:
+            rows = rows[:self._limit]
+        return rows
+
+    def stream(self, transaction=None):
+        rows = self._matching_rows()
+        self._client._round_trip(reads=max(1, len(rows)))
+        for doc_id, data in rows:
+            reference = DocumentReference(self._client, self._collection_path, doc_id)
+            yield DocumentSnapshot(reference, copy.deepcopy(data), self._fields)
+
+    def get(self, transaction=None):
+        return list(self.stream(transaction=transaction))
+
+
+class CollectionReference(Query):
+    def __init__(self, client, path):
+        super().__init__(client, path)
+        self.id = path.split("/")[-1]
+
+    def document(self, document_id=None):
+        return DocumentReference(self._client, self._collection_path, document_id or uuid.uuid4().hex[:20])
+
+    def add(self, data):
+        reference = self.document()
+        reference.set(data)
+        return None, reference
+
+
+class ExistsOption:
+    def __init__(self, exists):
+        self.exists = exists
+
+
+class WriteBatch:
+    def __init__(self, client):
+        self._client = client
+        self._writes = []
+
+    def set(self, reference, data, merge=False):
+        self._writes.append(("set", reference, data, merge))
+        return self
+
+    def update(self, reference, data):
+        self._writes.append(("update", reference, data, None))
+        return self
+
+    def create(self, reference, data):
+        self._writes.append(("create", reference, data, None))
+        return self
+
+    def delete(self, reference, option=None):
+        self._writes.append(("delete", reference, None, option))
+        return self
+
+    def __len__(self):
+        return len(self._writes)
+
+    def commit(self):
+        self._client._commit(self._writes)
+        self._writes = []
+
+
+class Transaction(WriteBatch):
+    """Transactions run under the client's lock, so they never conflict"""
+    _read_only = False
+    _max_attempts = 5
+
+    def __init__(self, client):
+        super().__init__(client)
+        self._id = None
+
+    def _clean_up(self):
+        self._writes = []
+        self._id = None
+
+    def _begin(self, retry_id=None):
+        self._client._lock.acquire()
+        self._id = b"transaction"
+
+    def _commit(self):
+        try:
+            self.commit()
+        finally:
+            self._release()
+
+    def _rollback(self):
+        self._writes = []
+        self._release()
+
+    def _release(self):
+        if self._id is not None:
+            self._id = None
+            self._client._lock.release()
+
+    def get(self, ref_or_query):
+        if isinstance(ref_or_query, DocumentReference):
+            return ref_or_query.get(transaction=self)
+        return ref_or_query.stream(transaction=self)
+
+
+class Client:
+    """Drop-in replacement for firestore.Client backed by dictionaries
+
+    ``latency`` (seconds) is slept on every round trip. ``calls`` counts round
+    trips, document reads, document writes and commits.
+    """
+
+    def __init__(self, *args, latency: float = 0.0, **kwargs):
+        self.latency = latency
+        self.calls = defaultdict(int)
+        self._collections = defaultdict(dict)
+        # (collection path, field) -> {value: set of doc ids}, built on first use
+        self._indexes = {}
+        self._lock = threading.RLock()
+
+    # Public API
+    def collection(self, path):
+        return CollectionReference(self, path)
+
+    def document(self, path):
+        collection_path, _, doc_id = path.rpartition("/")
+        return DocumentReference(self, collection_path, doc_id)
+
+    def batch(self):
+        return WriteBatch(self)
+
+    def transaction(self, **kwargs):
+        return Transaction(self)
+
+    def write_option(self, exists=None, **kwargs):
+        return ExistsOption(exists)
+
+    def get_all(self, references, field_paths=None, transaction=None):
+        references = list(references)
+        self._round_trip(reads=len(references))
+        for reference in references:
+            yield DocumentSnapshot(reference, self._read(reference), field_paths)
+
+    def reset_calls(self):
+        self.calls = defaultdict(int)
+
+    # Internals
+    def _round_trip(self, reads=0, writes=0):
+        self.calls["round_trips"] += 1
+        self.calls["reads"] += reads
+        self.calls["writes"] += writes
+        if self.latency:
+            time.sleep(self.latency)
+
+    def _read(self, reference):
+        with self._lock:
+            data = self._collections[reference._collection_path].get(reference.id)
+            return copy.deepcopy(data) if data is not None else None
+
+    def _candidates(self, collection_path, filters):
+        """Documents of a collection, narrowed by an equality index when one applies"""
+        with self._lock:
+            documents = self._collections[collection_path]
+            for field_path, op, value in filters:
+                if op == "==" and field_path != "__name__":
+                    doc_ids = self._index(collection_path, field_path).get(value, ())
+                    return [(doc_id, documents[doc_id]) for doc_id in list(doc_ids)]
+            return list(documents.items())
+
+    def _index(self, collection_path, field_path):
+        key = (collection_path, field_path)
+        if key not in self._indexes:
+            index = defaultdict(set)
+            for doc_id, data in self._collections[collection_path].items():
+                if field_path in data:
+                    index[self._hashable(data[field_path])].add(doc_id)
+            self._indexes[key] = index
+        return self._indexes[key]
+
+    @staticmethod
+    def _hashable(value):
+        return value if isinstance(value, (str, int, float, bool, type(None))) else repr(value)
+
+    def _store(self, collection_path, doc_id, data):
+        documents = self._collections[collection_path]
+        old = documents.get(doc_id)
+        for (indexed_path, field_path), index in self._indexes.items():
+            if indexed_path != collection_path:
+                continue
+            if old is not None and field_path in old:
+                index[self._hashable(old[field_path])].discard(doc_id)
+            if data is not None and field_path in data:
+                index[self._hashable(data[field_path])].add(doc_id)
+        if data is None:
+            documents.pop(doc_id, None)
+        else:
+            documents[doc_id] = data
+
+    def _commit(self, writes):
+        with self._lock:
+            # Check every precondition before applying anything, like a real commit
+            for kind, reference, _, option in writes:
+                exists = reference.id in self._collections[reference._collection_path]
+                if kind == "create" and exists:
+                    raise AlreadyExists(f"Document already exists: {reference.path}")
+                if kind == "update" and not exists:
+                    raise NotFound(f"No document to update: {reference.path}")
+                if kind == "delete" and option is not None and option.exists and not exists:
+                    raise NotFound(f"No document to delete: {reference.path}")
+
+            staged = {}
+            for kind, reference, data, merge in writes:
+                key = (reference._collection_path, reference.id)
+                current = staged.get(key, self._collections[reference._collection_path].get(reference.id))
+                if kind == "delete":
+                    staged[key] = None
+                elif kind == "update" or (kind == "set" and merge):
+                    staged[key] = self._apply(copy.deepcopy(current or {}), data)
+                else:
+                    staged[key] = self._apply({}, data)
+            for (collection_path, doc_id), data in staged.items():
+                self._store(collection_path, doc_id, data)
+            self.calls["commits"] += 1
+        self._round_trip(writes=len(writes))
+
+    @staticmethod
+    def _apply(document, data):
+        for field_path, value in data.items():
+            parts = field_path.split(".")
+            target = document
+            for part in parts[:-1]:
+                target = target.setdefault(part, {})
+            field = parts[-1]
+            if value is transforms.DELETE_FIELD:
+                target.pop(field, None)
+            elif value is transforms.SERVER_TIMESTAMP:
+                target[field] = datetime.now(timezone.utc)
+            elif isinstance(value, Increment):
+                target[field] = (target.get(field) or 0) + value.value
+            elif isinstance(value, ArrayUnion):
+                current = list(target.get(field) or [])
+                target[field] = current + [item for item in value.values if item not in current]
+            elif isinstance(value, ArrayRemove):
+                target[field] = [item for item in (target.get(field) or []) if item not in value.values]
+            else:
+                target[field] = copy.deepcopy(value)
+        return document
@@ -0,0 +1,304 @@
+"""Load test the app against seeded data and report latency and Firestore usage.
+
+Usage:
+    python bench/run.py                                  # in-memory Firestore, 10/1k/100k followers
+    python bench/run.py --followers 10,1000 --requests 500 --concurrency 20
+    python bench/run.py --scenarios home,explore,profile,follow --latency-ms 2
+    python bench/run.py --cold                           # bypass the page and user caches
+    FIRESTORE_EMULATOR_HOST=localhost:8080 python bench/run.py --backend emulator
+
+The app runs under uvicorn on a loopback port in this process and is driven
+by an httpx client with a fixed number of concurrent workers. Each scenario
+reports p50/p95/p99 latency, throughput and, per request, how many run_db
+calls it made; with the in-memory backend also Firestore round trips,
+document reads, document writes and commits.
+
+The in-memory backend (bench/fake_firestore.py) answers instantly unless
+--latency-ms is given, so its latencies show the app's own overhead. The call
+counts are the stable numbers to compare between changes. The emulator
+backend clears the emulator's database before seeding.
+
+Sign-in is stubbed: tokens of the form "bench:<user id>" are accepted as
+that user.
+"""
+import argparse
+import asyncio
+import io
+import json
+import os
+import socket
+import sys
+import shutil
+import tempfile
+import threading
+import time
+from collections import Counter
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+SCENARIOS = ("home", "explore", "profile", "followers", "search", "comments", "create-post", "add-comment", "follow")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--backend", choices=("memory", "emulator"), default="memory")
+    parser.add_argument("--followers", default="10,1000,100000",
+                        help="Comma separated follower counts of the seeded authors")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS),
+                        help=f"Comma separated subset of: {', '.join(SCENARIOS)}")
+    parser.add_argument("--requests", type=int, default=200, help="Requests per scenario")
+    parser.add_argument("--concurrency", type=int, default=10, help="Requests in flight at once")
+    parser.add_argument("--latency-ms", type=float, default=0.0,
+                        help="Delay added to every in-memory Firestore round trip")
+    parser.add_argument("--cold", action="store_true", help="Disable the page and user caches")
+    parser.add_argument("--json", help="Also write the results to this file")
+    return parser.parse_args()
+
+
+def install_fakes(args):
+    """Point the app at the chosen Firestore and accept benchmark tokens, before main is imported"""
+    import google.oauth2.id_token
+    from google.cloud import firestore
+
+    def verify_bench_token(token, request, audience=None, clock_skew_in_seconds=0):
+        prefix, _, user_id = token.partition(":")
+        if prefix != "bench" or not user_id:
+            raise ValueError("Not a benchmark token")
+        return {"user_id": user_id, "name": user_id, "email": f"{user_id}@example.com", "exp": time.time() + 3600}
+
+    google.oauth2.id_token.verify_firebase_token = verify_bench_token
+
+    if args.backend == "memory":
+        import fake_firestore
+        latency = args.latency_ms / 1000
+
+        def client(*client_args, **client_kwargs):
+            return fake_firestore.Client(latency=latency)
+
+        firestore.Client = client
+    else:
+        host = os.environ.get("FIRESTORE_EMULATOR_HOST")
+        if not host:
+            sys.exit("--backend emulator needs FIRESTORE_EMULATOR_HOST")
+        project = os.environ.setdefault("GOOGLE_CLOUD_PROJECT", "bench")
+        import requests
+        requests.delete(f"http://{host}/emulator/v1/projects/{project}/databases/(default)/documents").raise_for_status()
+
+
+class CallCounter:
+    """Counts run_db calls and tracks work still running after a response was sent"""
+
+    def __init__(self, main):
+        self.calls = 0
+        self.pending = 0
+        self.job_queue = main.job_queue
+        run_db = main.run_db
+
+        async def counted_run_db(func, *args, **kwargs):
+            self.calls += 1
+            self.pending += 1
+            try:
+                return await run_db(func, *args, **kwargs)
+            finally:
+                self.pending -= 1
+
+        main.run_db = counted_run_db
+
+    async def drain(self, quiet_for: float = 0.2):
+        """Wait for background jobs, so their calls are charged to the scenario that caused them"""
+        quiet_since = time.monotonic()
+        while time.monotonic() - quiet_since < quiet_for:
+            await asyncio.sleep(0.02)
+            if self.pending or self.job_queue.pending:
+                quiet_since = time.monotonic()
+
+
+def sample_image(index: int) -> bytes:
+    """A small JPEG that differs per request, so uploads are never deduplicated"""
+    from PIL import Image
+    image = Image.new("RGB", (640, 480), ((index * 37) % 256, (index * 91) % 256, (index * 53) % 256))
+    buffer = io.BytesIO()
+    image.save(buffer, "JPEG", quality=85)
+    return buffer.getvalue()
+
+
+def build_scenarios(names, follower_counts, requests):
+    """Map scenario labels to functions building the i-th request as (method, path, user, kwargs)"""
+    import seed
+
+    scenarios = {}
+    for name in names:
+        if name == "home":
+            scenarios["home"] = lambda i: ("GET", "/", "viewer", {})
+        elif name == "explore":
+            # Many viewers, so each request renders its own page from the shared ranking
+            scenarios["explore"] = lambda i: ("GET", "/explore", seed.fan_id(i % follower_counts[0]), {})
+        elif name == "search":
+            scenarios["search"] = lambda i: ("GET", f"/search?query=fan {i % 1000:03d}", "viewer", {})
+        elif name == "add-comment":
+            post_id = seed.hot_post_id(follower_counts[0])
+            scenarios["add-comment"] = lambda i, post_id=post_id: (
+                "POST", f"/add-comment/{post_id}", seed.fan_id(i % follower_counts[0]),
+                {"data": {"comment_text": f"Benchmark comment {i}"}}
+            )
+        else:
+            for count in follower_counts:
+                author_id = seed.celebrity_id(count)
+                label = f"{name}[{count}]"
+                if name == "profile":
+                    scenarios[label] = lambda i, a=author_id: ("GET", f"/profile/{a}", "viewer", {})
+                elif name == "followers":
+                    scenarios[label] = lambda i, a=author_id: ("GET", f"/followers/{a}", "viewer", {})
+                elif name == "comments":
+                    scenarios[label] = lambda i, p=seed.hot_post_id(count): ("GET", f"/posts/{p}/comments", "viewer", {})
+                elif name == "create-post":
+                    scenarios[label] = lambda i, a=author_id: (
+                        "POST", "/create-post", a,
+                        {"data": {"caption": f"Benchmark post {i}"},
+                         "files": {"image": (f"bench{i}.jpg", sample_image(i), "image/jpeg")}}
+                    )
+                elif name == "follow":
+                    scenarios[label] = lambda i, a=author_id: ("POST", f"/follow/{a}", seed.newcomer_id(i % requests), {})
+    return scenarios
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, round(fraction * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+
+async def run_scenario(client, make_request, requests, concurrency, counter, db):
+    """Send requests with a fixed number of workers and return the measurements"""
+    latencies = []
+    statuses = Counter()
+    next_index = iter(range(requests))
+
+    async def worker():
+        for index in next_index:
+            method, path, user_id, kwargs = make_request(index)
+            headers = {"Authorization": f"Bearer bench:{user_id}"}
+            started = time.perf_counter()
+            response = await client.request(method, path, headers=headers, **kwargs)
+            latencies.append(time.perf_counter() - started)
+            statuses[response.status_code] += 1
+
+    calls_before = counter.calls
+    db_calls_before = dict(getattr(db, "calls", {}))
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - started
+    await counter.drain()
+
+    latencies.sort()
+    result = {
+        "requests": requests,
+        "statuses": dict(statuses),
+        "p50_ms": percentile(latencies, 0.50) * 1000,
+        "p95_ms": percentile(latencies, 0.95) * 1000,
+        "p99_ms": percentile(latencies, 0.99) * 1000,
+        "throughput_rps": requests / elapsed if elapsed else 0.0,
+        "run_db_per_request": (counter.calls - calls_before) / requests,
+    }
+    for key, value in getattr(db, "calls", {}).items():
+        result[f"{key}_per_request"] = (value - db_calls_before.get(key, 0)) / requests
+    return result
+
+
+def print_table(results):
+    columns = [("p50_ms", "p50 ms"), ("p95_ms", "p95 ms"), ("p99_ms", "p99 ms"), ("throughput_rps", "req/s"),
+               ("run_db_per_request", "run_db"), ("round_trips_per_request", "rpcs"),
+               ("reads_per_request", "reads"), ("writes_per_request", "writes"), ("commits_per_request", "commits")]
+    columns = [column for column in columns if any(column[0] in result for result in results.values())]
+    width = max(len(label) for label in results) + 2
+    print("scenario".ljust(width) + "".join(title.rjust(10) for _, title in columns) + "  statuses")
+    for label, result in results.items():
+        cells = "".join(f"{result.get(key, 0):10.1f}" for key, _ in columns)
+        statuses = " ".join(f"{status}x{count}" for status, count in sorted(result["statuses"].items()))
+        print(label.ljust(width) + cells + "  " + statuses)
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def main():
+    args = parse_args()
+    follower_counts = sorted(int(count) for count in args.followers.split(","))
+    names = [name.strip() for name in args.scenarios.split(",") if name.strip()]
+    unknown = set(names) - set(SCENARIOS)
+    if unknown:
+        sys.exit(f"Unknown scenarios: {', '.join(sorted(unknown))}")
+
+    install_fakes(args)
+    os.chdir(ROOT)
+    media_dir = tempfile.mkdtemp(prefix="bench-media-")
+    os.environ["MEDIA_DIR"] = media_dir
+    os.environ["JOB_JOURNAL_PATH"] = os.path.join(media_dir, "jobs.sqlite3")
+
+    import httpx
+    import uvicorn
+    import main as app_main
+    import seed
+
+    if args.cold:
+        app_main.page_cache.ttl = 0
+        app_main.user_cache.ttl = 0
+    # Scenarios replay one user's requests far faster than the per-user limits allow
+    app_main.rate_limiter.limits = {route: (float("inf"), 0.0) for route in app_main.RATE_LIMITS}
+
+    db = app_main.firestore_db
+    print(f"Seeding {args.backend} Firestore...", flush=True)
+    started = time.perf_counter()
+    newcomers = max(args.requests, 1)
+    summary = seed.seed(db, follower_counts, newcomers=newcomers)
+    print(f"Seeded {summary['documents']} documents in {time.perf_counter() - started:.1f}s", flush=True)
+    if hasattr(db, "reset_calls"):
+        db.reset_calls()
+
+    counter = CallCounter(app_main)
+    scenarios = build_scenarios(names, follower_counts, newcomers)
+
+    port = free_port()
+    server = uvicorn.Server(uvicorn.Config(app_main.app, host="127.0.0.1", port=port, log_level="warning"))
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    while not server.started:
+        if not thread.is_alive():
+            sys.exit("Server failed to start")
+        time.sleep(0.05)
+
+    async def run_all():
+        limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+        async with httpx.AsyncClient(base_url=f"http://127.0.0.1:{port}", limits=limits, timeout=120) as client:
+            results = {}
+            for label, make_request in scenarios.items():
+                print(f"Running {label}...", flush=True)
+                results[label] = await run_scenario(
+                    client, make_request, args.requests, args.concurrency, counter, db
+                )
+            return results
+
+    try:
+        results = asyncio.run(run_all())
+    finally:
+        server.should_exit = True
+        thread.join()
+        shutil.rmtree(media_dir, ignore_errors=True)
+
+    print()
+    print(f"{args.requests} requests per scenario, concurrency {args.concurrency}, "
+          f"backend {args.backend}, caches {'off' if args.cold else 'on'}; counts are per request")
+    print_table(results)
+    if args.json:
+        with open(args.json, "w") as output:
+            json.dump({"args": vars(args), "results": results}, output, indent=2)
+
+
+if __name__ == "__main__":
+    main()
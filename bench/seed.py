@@ -0,0 +1,177 @@
+"""Synthetic data for the benchmarks.
+
+Writes a follow graph around a few "celebrity" authors with different
+follower counts, their posts (one of them with a long comment thread), a
+viewer who follows all of them and a pool of users who follow nobody yet.
+Documents use the current schema (follow edges, denormalized counts,
+timelines, comment subcollections and the trending ranking), so no request
+pays for a migration.
+
+Everything goes through the ordinary client API in batches, so the same code
+seeds the in-memory fake and the Firestore emulator.
+"""
+import math
+from datetime import datetime, timedelta
+
+BATCH_SIZE = 400
+POSTS_PER_AUTHOR = 24
+HOT_POST_COMMENTS = 500
+COMMENT_PREVIEW_SIZE = 5
+FAN_OUT_THRESHOLD = 10000   # Matches FANOUT_FOLLOWER_THRESHOLD in main.py
+TRENDING_HALF_LIFE = 6 * 3600   # Matches TRENDING_HALF_LIFE in main.py
+TRENDING_CANDIDATES = 500
+BASE_DATE = datetime(2026, 1, 1)
+
+
+def celebrity_id(follower_count: int) -> str:
+    return f"celeb_{follower_count}"
+
+
+def fan_id(index: int) -> str:
+    return f"fan{index:06d}"
+
+
+def newcomer_id(index: int) -> str:
+    return f"new{index:06d}"
+
+
+def hot_post_id(follower_count: int) -> str:
+    return f"{celebrity_id(follower_count)}_post00"
+
+
+class BatchWriter:
+    """Collects sets into batches of BATCH_SIZE and commits them as they fill"""
+
+    def __init__(self, db):
+        self.db = db
+        self.batch = db.batch()
+        self.count = 0
+
+    def set(self, ref, data):
+        self.batch.set(ref, data)
+        self.count += 1
+        if len(self.batch) >= BATCH_SIZE:
+            self.flush()
+
+    def flush(self):
+        if len(self.batch):
+            self.batch.commit()
+        self.batch = self.db.batch()
+
+
+def user_doc(name: str, username: str, follower_count: int = 0, following_count: int = 0, post_count: int = 0):
+    return {
+        "name": name,
+        "username": username,
+        "name_lower": name.lower(),
+        "username_lower": username.lower(),
+        "email": f"{username}@example.com",
+        "created_at": BASE_DATE.isoformat(),
+        "follower_count": follower_count,
+        "following_count": following_count,
+        "post_count": post_count,
+        "follow_edges_migrated": True,
+        "follow_graph_migrated": True,
+        "timeline_backfilled": True,
+    }
+
+
+def edge_doc(follower_id: str, follower_name: str, followee_id: str, followee_name: str):
+    return {
+        "follower_id": follower_id,
+        "followee_id": followee_id,
+        "follower_sort_name": follower_name.lower(),
+        "followee_sort_name": followee_name.lower(),
+        "created_at": BASE_DATE.isoformat(),
+    }
+
+
+def seed(db, follower_counts=(10, 1000, 100000), newcomers: int = 1000):
+    """Write the benchmark data set and return a description of it"""
+    writer = BatchWriter(db)
+    users = db.collection("users")
+    follows = db.collection("follows")
+    posts = db.collection("posts")
+    follower_counts = sorted(follower_counts)
+    max_fans = max(follower_counts)
+    trending = []
+
+    fan_following = {index: 0 for index in range(max_fans)}
+    for count in follower_counts:
+        for index in range(count):
+            fan_following[index] += 1
+
+    for index in range(max_fans):
+        name = f"Fan {index:06d}"
+        writer.set(users.document(fan_id(index)), user_doc(name, fan_id(index), following_count=fan_following[index]))
+    for index in range(newcomers):
+        name = f"Newcomer {index:06d}"
+        writer.set(users.document(newcomer_id(index)), user_doc(name, newcomer_id(index)))
+    writer.set(users.document("viewer"), user_doc("Viewer", "viewer", following_count=len(follower_counts)))
+
+    for count in follower_counts:
+        author_id = celebrity_id(count)
+        author_name = f"Celebrity {count}"
+        author = user_doc(author_name, author_id, follower_count=count + 1, post_count=POSTS_PER_AUTHOR)
+        high_fanout = count + 1 > FAN_OUT_THRESHOLD
+        if high_fanout:
+            author["fanout_on_read"] = True
+        writer.set(users.document(author_id), author)
+
+        writer.set(follows.document(f"viewer_{author_id}"), edge_doc("viewer", "Viewer", author_id, author_name))
+        for index in range(count):
+            writer.set(
+                follows.document(f"{fan_id(index)}_{author_id}"),
+                edge_doc(fan_id(index), f"Fan {index:06d}", author_id, author_name)
+            )
+
+        for number in range(POSTS_PER_AUTHOR):
+            post_id = f"{author_id}_post{number:02d}"
+            date = (BASE_DATE + timedelta(hours=number)).isoformat()
+            post = {
+                "id": post_id,
+                "user_id": author_id,
+                "user_name": author_name,
+                "caption": f"Post {number} by {author_name}",
+                "image_url": "/static/placeholder.jpg",
+                "date": date,
+                "likes": 0,
+                "comment_count": 0,
+                "latest_comments": [],
+            }
+            if post_id == hot_post_id(count):
+                comments = []
+                for comment_number in range(HOT_POST_COMMENTS):
+                    commenter = fan_id(comment_number % max_fans)
+                    comment = {
+                        "user_id": commenter,
+                        "username": commenter,
+                        "text": f"Comment {comment_number}",
+                        "date": (BASE_DATE + timedelta(seconds=comment_number)).isoformat(),
+                    }
+                    comment_ref = posts.document(post_id).collection("comments").document(f"c{comment_number:05d}")
+                    writer.set(comment_ref, {**comment, "created_at": BASE_DATE})
+                    comments.append({**comment, "id": comment_ref.id})
+                post["comment_count"] = len(comments)
+                post["latest_comments"] = comments[-COMMENT_PREVIEW_SIZE:]
+            writer.set(posts.document(post_id), post)
+            # Scored as main.record_engagement would: the post itself plus three per comment
+            score = math.log2(1 + 3 * post["comment_count"]) + datetime.fromisoformat(date).timestamp() / TRENDING_HALF_LIFE
+            trending.append({"post_id": post_id, "score": score})
+
+            # Timelines are only seeded for the users the benchmarks read feeds as
+            entry = {"post_id": post_id, "user_id": author_id, "date": date}
+            writer.set(db.collection("timelines").document(author_id).collection("posts").document(post_id), entry)
+            if not high_fanout:
+                writer.set(db.collection("timelines").document("viewer").collection("posts").document(post_id), entry)
+
+    trending.sort(key=lambda entry: entry["score"], reverse=True)
+    writer.set(db.collection("trending").document("posts"), {"ranking": trending[:TRENDING_CANDIDATES]})
+
+    writer.flush()
+    return {
+        "celebrities": [celebrity_id(count) for count in follower_counts],
+        "fans": max_fans,
+        "newcomers": newcomers,
+        "documents": writer.count,
+    }
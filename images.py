@@ -0,0 +1,52 @@
+"""Image derivative generation.
+
+Runs inside the image process pool. Workers import this module by name to
+call generate_image_variants, so it stays free of any app or Firestore setup
+and only depends on Pillow. (They also import the launching process's
+__main__ module, which is why main.py hands over to "python -m uvicorn".)
+"""
+import os
+from PIL import Image, ImageOps
+
+# Variant name -> longest edge in pixels
+IMAGE_VARIANTS = {
+    "thumb": 320,
+    "feed": 1080,
+    "full": 2048,
+}
+VARIANT_JPEG_QUALITY = 82
+
+
+def generate_image_variants(source_path: str, output_dir: str, base_name: str):
+    """Write resized JPEG variants of an image and describe them
+
+    Each variant is scaled down to fit its size (never up), rotated according
+    to its EXIF orientation, flattened onto white if it has transparency and
+    re-encoded as a progressive JPEG without metadata. Returns a mapping of
+    variant name to {"path", "width", "height"}.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    variants = {}
+
+    with Image.open(source_path) as original:
+        image = ImageOps.exif_transpose(original)
+        if image.mode in ("RGBA", "LA", "P"):
+            image = image.convert("RGBA")
+            background = Image.new("RGB", image.size, (255, 255, 255))
+            background.paste(image, mask=image.getchannel("A"))
+            image = background
+        elif image.mode != "RGB":
+            image = image.convert("RGB")
+
+        for name, max_edge in IMAGE_VARIANTS.items():
+            variant = image.copy()
+            variant.thumbnail((max_edge, max_edge), Image.LANCZOS)
+
+            path = os.path.join(output_dir, f"{base_name}_{name}.jpg")
+            temp_path = f"{path}.tmp"
+            variant.save(temp_path, "JPEG", quality=VARIANT_JPEG_QUALITY, optimize=True, progressive=True)
+            os.replace(temp_path, path)
+
+            variants[name] = {"path": path, "width": variant.width, "height": variant.height}
+
+    return variants
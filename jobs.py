@@ -0,0 +1,291 @@
+"""Background jobs with a durable journal.
+
+Routes enqueue work that doesn't have to finish before the response (timeline
+fan-out, image resizing) and return straight away. Jobs are written to a local
+SQLite journal before they are queued, run on a fixed number of worker tasks
+in the app's event loop, retried with exponential backoff when they raise and
+picked up again after a restart if they never finished.
+
+Several worker processes can share one journal. A process owns the jobs it
+enqueued under a lease it keeps renewing; jobs whose lease ran out because
+their process stopped or died are claimed, inside a write transaction, by
+whichever process looks next.
+
+A job runs at least once, so handlers must be safe to repeat. An idempotency
+key makes enqueueing the same work twice a no-op for as long as the journal
+remembers the key.
+"""
+import asyncio
+import json
+import logging
+import os
+import random
+import sqlite3
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Optional
+
+logger = logging.getLogger("instagram_replica.jobs")
+
+JOURNAL_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    key TEXT UNIQUE,
+    name TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    status TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    run_after REAL NOT NULL,
+    updated_at REAL NOT NULL,
+    error TEXT,
+    owner TEXT,
+    lease_until REAL NOT NULL DEFAULT 0
+)
+"""
+# Columns added since the first journals were created: name -> definition
+JOURNAL_MIGRATIONS = {"owner": "TEXT", "lease_until": "REAL NOT NULL DEFAULT 0"}
+PURGE_INTERVAL = 3600   # Seconds between sweeps of finished jobs out of the journal
+
+
+class Journal:
+    """The SQLite table of jobs; every method blocks, so JobQueue runs them on its own thread"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._conn = None
+
+    def open(self):
+        self._conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(JOURNAL_SCHEMA)
+        columns = {row[1] for row in self._conn.execute("PRAGMA table_info(jobs)")}
+        for column, definition in JOURNAL_MIGRATIONS.items():
+            if column not in columns:
+                self._conn.execute(f"ALTER TABLE jobs ADD COLUMN {column} {definition}")
+
+    def close(self):
+        if self._conn:
+            self._conn.close()
+            self._conn = None
+
+    def add(self, name: str, payload: str, key: Optional[str], owner: str, lease_until: float) -> Optional[int]:
+        """Record a pending job owned by owner, returning its ID, or None if a job with the key is already known"""
+        now = time.time()
+        cursor = self._conn.execute(
+            "INSERT OR IGNORE INTO jobs (key, name, payload, status, run_after, updated_at, owner, lease_until) "
+            "VALUES (?, ?, ?, 'pending', ?, ?, ?, ?)",
+            (key, name, payload, now, now, owner, lease_until)
+        )
+        return cursor.lastrowid if cursor.rowcount else None
+
+    def claim(self, owner: str, lease_until: float):
+        """Take over the pending jobs whose lease ran out and return them
+
+        BEGIN IMMEDIATE holds the journal's write lock from the read on, so two
+        processes never claim the same job.
+        """
+        self._conn.execute("BEGIN IMMEDIATE")
+        try:
+            jobs = self._conn.execute(
+                "SELECT id, name, payload, attempts, run_after FROM jobs "
+                "WHERE status = 'pending' AND lease_until < ? AND (owner IS NULL OR owner != ?) ORDER BY id",
+                (time.time(), owner)
+            ).fetchall()
+            self._conn.executemany(
+                "UPDATE jobs SET owner = ?, lease_until = ? WHERE id = ?",
+                [(owner, lease_until, job[0]) for job in jobs]
+            )
+            self._conn.execute("COMMIT")
+        except BaseException:
+            self._conn.execute("ROLLBACK")
+            raise
+        return jobs
+
+    def renew(self, owner: str, lease_until: float):
+        """Extend the lease on every pending job owner holds (lease_until 0 gives them up)"""
+        self._conn.execute(
+            "UPDATE jobs SET lease_until = ? WHERE owner = ? AND status = 'pending'",
+            (lease_until, owner)
+        )
+
+    def finish(self, job_id: int, status: str, attempts: int, error: Optional[str] = None):
+        self._conn.execute(
+            "UPDATE jobs SET status = ?, attempts = ?, error = ?, updated_at = ? WHERE id = ?",
+            (status, attempts, error, time.time(), job_id)
+        )
+
+    def retry(self, job_id: int, attempts: int, run_after: float, error: str):
+        self._conn.execute(
+            "UPDATE jobs SET attempts = ?, run_after = ?, error = ?, updated_at = ? WHERE id = ?",
+            (attempts, run_after, error, time.time(), job_id)
+        )
+
+    def purge(self, older_than: float):
+        """Forget finished jobs (and with them their idempotency keys) last touched before older_than"""
+        self._conn.execute("DELETE FROM jobs WHERE status != 'pending' AND updated_at < ?", (older_than,))
+
+
+class JobQueue:
+    """A bounded pool of async workers running journaled jobs
+
+    Handlers are coroutine functions registered by name and called with the
+    job's JSON payload as keyword arguments. A handler that raises is retried
+    up to max_attempts times, waiting base_delay * 2**n seconds (capped at
+    max_delay, with jitter) in between; after that the job is marked failed.
+    observer, if given, is called as observer(name, outcome, seconds) after
+    every attempt, with outcome "done", "retry" or "failed".
+
+    The queue holds its jobs for lease seconds at a time and renews the lease
+    every lease / 3 seconds, claiming other processes' expired jobs as it goes.
+
+    The queue is bounded at admission: routes check full() before taking on
+    work that will enqueue jobs, so work already committed is never refused.
+    """
+
+    def __init__(self, journal_path: str, workers: int = 4, max_pending: int = 10000,
+                 max_attempts: int = 5, base_delay: float = 1.0, max_delay: float = 300.0,
+                 retention: float = 86400.0, lease: float = 60.0, observer: Optional[Callable] = None):
+        self.journal = Journal(journal_path)
+        self.workers = workers
+        self.max_pending = max_pending
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.retention = retention
+        self.lease = lease
+        self.observer = observer
+        self.owner = f"{os.getpid()}-{uuid.uuid4().hex[:8]}"   # Unique even if the PID is reused
+        self.handlers = {}
+        self.pending = 0        # Jobs journaled and not yet done or failed
+        self._queue = None
+        self._tasks = []
+        self._timers = set()
+        self._journal_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="job-journal")
+        self._purged_at = float("-inf")
+
+    def register(self, name: str, handler: Callable):
+        self.handlers[name] = handler
+
+    def full(self) -> bool:
+        return self.pending >= self.max_pending
+
+    async def _journal(self, method, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._journal_executor, method, *args)
+
+    async def start(self):
+        """Open the journal, queue the jobs nobody holds a lease on and start the workers"""
+        self._queue = asyncio.Queue()
+        await self._journal(self.journal.open)
+        await self._purge()
+        await self._claim()
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+        self._tasks.append(asyncio.create_task(self._keep_leases()))
+
+    async def stop(self):
+        """Stop the workers and give up the leases; unfinished jobs stay in the journal for the next start"""
+        for timer in self._timers:
+            timer.cancel()
+        self._timers.clear()
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        self.pending = 0
+        await self._journal(self.journal.renew, self.owner, 0)
+        await self._journal(self.journal.close)
+
+    async def enqueue(self, name: str, key: Optional[str] = None, **payload) -> bool:
+        """Journal a job and queue it, returning False if a job with the same key was already enqueued"""
+        if name not in self.handlers:
+            raise KeyError(f"No handler registered for job {name!r}")
+        payload = json.dumps(payload)
+        job_id = await self._journal(self.journal.add, name, payload, key, self.owner, time.time() + self.lease)
+        if job_id is None:
+            return False
+        self.pending += 1
+        self._queue.put_nowait((job_id, name, payload, 0))
+        return True
+
+    async def join(self):
+        """Wait until no jobs are pending (retries included)"""
+        while self.pending:
+            await asyncio.sleep(0.01)
+
+    async def _claim(self):
+        """Queue the jobs whose lease ran out, left over from a stopped or dead process"""
+        claimed = await self._journal(self.journal.claim, self.owner, time.time() + self.lease)
+        for job_id, name, payload, attempts, run_after in claimed:
+            self.pending += 1
+            self._schedule((job_id, name, payload, attempts), run_after - time.time())
+        if claimed:
+            logger.info("Resuming background jobs", extra={"fields": {"jobs": len(claimed)}})
+
+    async def _keep_leases(self):
+        while True:
+            await asyncio.sleep(self.lease / 3)
+            try:
+                await self._journal(self.journal.renew, self.owner, time.time() + self.lease)
+                await self._claim()
+            except sqlite3.Error:
+                logger.exception("Error renewing background job leases")
+
+    def _schedule(self, job, delay: float):
+        if delay <= 0:
+            self._queue.put_nowait(job)
+            return
+        loop = asyncio.get_running_loop()
+
+        def release():
+            self._timers.discard(timer)
+            self._queue.put_nowait(job)
+
+        timer = loop.call_later(delay, release)
+        self._timers.add(timer)
+
+    def _backoff(self, attempts: int) -> float:
+        delay = min(self.max_delay, self.base_delay * 2 ** (attempts - 1))
+        return delay * random.uniform(0.5, 1.0)
+
+    async def _worker(self):
+        while True:
+            job = await self._queue.get()
+            await self._run(*job)
+
+    async def _run(self, job_id: int, name: str, payload: str, attempts: int):
+        attempts += 1
+        fields = {"job_id": job_id, "job": name, "attempt": attempts}
+        started = time.perf_counter()
+        try:
+            await self.handlers[name](**json.loads(payload))
+        except asyncio.CancelledError:
+            raise
+        except Exception as exc:
+            error = f"{type(exc).__name__}: {exc}"
+            if attempts < self.max_attempts:
+                delay = self._backoff(attempts)
+                logger.warning("Background job failed, will retry", extra={"fields": {**fields, "error": error, "retry_in": round(delay, 2)}})
+                self._observe(name, "retry", started)
+                await self._journal(self.journal.retry, job_id, attempts, time.time() + delay, error)
+                self._schedule((job_id, name, payload, attempts), delay)
+                return
+            logger.exception("Background job failed", extra={"fields": fields})
+            self._observe(name, "failed", started)
+            await self._journal(self.journal.finish, job_id, "failed", attempts, error)
+        else:
+            self._observe(name, "done", started)
+            await self._journal(self.journal.finish, job_id, "done", attempts)
+        self.pending -= 1
+        await self._purge()
+
+    def _observe(self, name: str, outcome: str, started: float):
+        if self.observer:
+            self.observer(name, outcome, time.perf_counter() - started)
+
+    async def _purge(self):
+        if time.monotonic() - self._purged_at < PURGE_INTERVAL:
+            return
+        self._purged_at = time.monotonic()
+        await self._journal(self.journal.purge, time.time() - self.retention)
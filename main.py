@@ -1,14 +1,53 @@
 import os
+import re
+import json
+import base64
+import time
+import asyncio
+import atexit
+import contextvars
+import hashlib
+import heapq
+import logging
+import math
+import mimetypes
+import multiprocessing
+import queue
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import uuid
+import zlib
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import contextmanager
 from datetime import datetime, timedelta
+from logging.handlers import QueueHandler, QueueListener
+import jinja2
 from fastapi import FastAPI, Request, Form, HTTPException, status, Cookie, Depends, Query
-from fastapi.responses import HTMLResponse, RedirectResponse, JSONResponse
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import HTMLResponse, RedirectResponse, JSONResponse, FileResponse, PlainTextResponse, Response, StreamingResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
+from starlette.concurrency import run_in_threadpool
+from starlette.datastructures import Headers, MutableHeaders, UploadFile
 import google.oauth2.id_token
 from google.auth.transport import requests
 from google.cloud import firestore
+from google.api_core.exceptions import AlreadyExists, NotFound
+from requests import Session
+from requests.adapters import HTTPAdapter
+from dateutil.relativedelta import relativedelta
 from typing import Optional, List
-from datetime import datetime
+from images import generate_image_variants
+try:
+    import brotli
+except ImportError:  # Optional: responses fall back to gzip without it
+    brotli = None
+from storage import LocalStorage, GCSStorage
+from jobs import JobQueue
 
 # Firebase Admin SDK JSON key
 os.environ["GOOGLE_APPLICATION_CREDENTIALS"] = "firebase-key.json"  
@@ -16,17 +55,1063 @@ os.environ["GOOGLE_APPLICATION_CREDENTIALS"] = "firebase-key.json"
 # Initialize FastAPI app
 app = FastAPI()
 
+# Token verification tuning
+CERTS_DEFAULT_MAX_AGE = 3600      # Fallback cert lifetime when Cache-Control is missing (seconds)
+CERTS_FETCH_TIMEOUT = 5           # Outbound timeout for the Google cert endpoint (seconds)
+TOKEN_CACHE_MAX_ENTRIES = 10000   # Upper bound on cached verified tokens
+
+# Rendered pages and the data behind them are cached in-process and dropped by the writes that change them
+PAGE_CACHE_TTL = 30               # Safety net for changes made by other instances (seconds)
+PAGE_CACHE_MAX_ENTRIES = 5000
+
+# Compact user records are cached in-process and dropped by profile updates and follows
+USER_CACHE_TTL = 120              # Safety net for changes made by other instances (seconds)
+USER_CACHE_MAX_ENTRIES = 50000
+USER_CACHE_LISTENER = os.environ.get("USER_CACHE_LISTENER") == "1"   # Also drop entries on Firestore changes
+
+# Blocking Firestore calls run on a bounded pool so they never stall the event loop
+FIRESTORE_MAX_WORKERS = int(os.environ.get("FIRESTORE_MAX_WORKERS", "32"))
+
+# Number of posts per page on the home feed and profile grid
+FEED_PAGE_SIZE = 10
+PROFILE_PAGE_SIZE = 12
+FOLLOW_LIST_PAGE_SIZE = 50
+SEARCH_RESULT_LIMIT = 20
+
+# Comments live in posts/{post_id}/comments; posts keep a count and a short preview
+COMMENT_PREVIEW_SIZE = 5
+COMMENT_PAGE_SIZE = 20
+
+# Likes are counted in sharded counters and rolled up onto the post periodically
+LIKE_SHARD_COUNT = 10
+LIKE_FLUSH_INTERVAL = 5   # Seconds between like count roll-ups
+
+# Explore ranks posts by engagement with time decay, from a ranking kept in one document
+TRENDING_HALF_LIFE = 6 * 3600      # Engagement counts half as much after this many seconds
+TRENDING_WEIGHTS = {"post": 1.0, "like": 1.0, "comment": 3.0}
+TRENDING_CANDIDATES = 500          # Posts kept in the stored ranking
+TRENDING_PAGE_SIZE = 30            # Posts shown on the explore page
+TRENDING_COMPACT_INTERVAL = 30     # Seconds between merges of new engagement into the ranking
+
+# Image upload limits
+UPLOAD_MAX_BYTES = 10 * 1024 * 1024    # Largest accepted image
+UPLOAD_FORM_OVERHEAD = 64 * 1024       # Allowance for the other form fields and multipart framing
+UPLOAD_CHUNK_SIZE = 64 * 1024          # Bytes copied to disk per read
+UPLOAD_PATHS = ("/create-post", "/update-profile")
+
+# Uploaded images are stored once per distinct content, named by their SHA-256
+STORAGE_BACKEND = os.environ.get("STORAGE_BACKEND", "local")   # "local" or "gcs"
+MEDIA_DIR = os.environ.get("MEDIA_DIR", "media")               # Blob directory for the local backend
+GCS_BUCKET = os.environ.get("GCS_BUCKET", "")
+SIGNED_URL_TTL = int(os.environ.get("SIGNED_URL_TTL", "3600")) # Lifetime of GCS read URLs (seconds)
+MEDIA_URL_PREFIX = "/media"
+MEDIA_CACHE_CONTROL = "public, max-age=31536000, immutable"
+BLOB_NAME_PATTERN = re.compile(r"^[0-9a-f]{64}(_[a-z]+)?\.(jpg|png|gif|webp)$")
+
+# Response compression and conditional requests
+COMPRESSION_MIN_SIZE = 1024         # Smaller responses are sent as-is (bytes)
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5
+COMPRESSIBLE_TYPES = ("text/", "application/json", "application/javascript", "image/svg+xml")
+STATIC_PAGES = {"login": "templates/login.html", "signup": "templates/signup.html"}
+
+# JSON API (/api/v1): fields clients may ask for, and what they get by default
+API_POST_FIELDS = ("user_id", "user_name", "caption", "image_url", "image_variants", "date", "likes", "comment_count", "latest_comments")
+API_POST_DEFAULT_FIELDS = ("user_id", "user_name", "caption", "image_url", "date", "likes", "comment_count")
+API_USER_FIELDS = ("name", "username", "bio", "profile_picture", "post_count", "follower_count", "following_count", "is_following")
+API_USER_DEFAULT_FIELDS = ("name", "username", "profile_picture", "post_count", "follower_count", "following_count")
+API_MAX_PAGE_SIZE = 50
+
+# Live updates are pushed to browsers over server-sent events
+EVENT_QUEUE_SIZE = 100            # Events buffered per connection; slower clients are disconnected
+EVENT_HEARTBEAT_INTERVAL = 15     # Seconds between keep-alive comments on an idle stream
+EVENT_RETRY_MS = 5000             # How long browsers wait before reconnecting
+EVENT_MAX_POSTS = 50              # Posts one connection can watch for new comments
+
+# Per-user token buckets for costly routes: route -> (burst size, tokens refilled per second)
+RATE_LIMITS = {
+    "create-post": (5, 1 / 30),
+    "add-comment": (20, 1 / 3),
+    "follow": (30, 1 / 2),
+    "search": (30, 1.0),
+    "like": (60, 1.0),      # Shared by like and unlike
+}
+RATE_LIMIT_MAX_BUCKETS = 100000
+
+# Firestore load shedding: new requests get 503 while calls back up past these limits
+FIRESTORE_MAX_PENDING = int(os.environ.get("FIRESTORE_MAX_PENDING", str(FIRESTORE_MAX_WORKERS * 8)))   # Calls running or queued
+FIRESTORE_MAX_QUEUE_WAIT = float(os.environ.get("FIRESTORE_MAX_QUEUE_WAIT", "0.5"))   # Average wait for a worker (seconds)
+FIRESTORE_HARD_LIMIT_FACTOR = 2      # Calls beyond this multiple of FIRESTORE_MAX_PENDING fail even mid-request
+SHED_RETRY_AFTER = 2                 # Retry-After sent with 503 responses (seconds)
+UNGUARDED_PATH_PREFIXES = ("/static/", "/media/", "/metrics", "/login", "/signup")   # Never touch Firestore
+
+# Logging and metrics
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO")
+SLOW_REQUEST_MS = float(os.environ.get("SLOW_REQUEST_MS", "0"))   # Log requests slower than this (0 disables)
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)   # Seconds
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 250, 500, 1000)   # Firestore calls or documents per request
+
+# Resized image variants are generated in a separate process pool
+IMAGE_WORKERS = int(os.environ.get("IMAGE_WORKERS", "2"))
+
+# Side effects of writes (timeline fan-out, image resizing) run as journaled background jobs
+JOB_JOURNAL_PATH = os.environ.get("JOB_JOURNAL_PATH", "jobs.sqlite3")   # Shared by all worker processes
+JOB_WORKERS = int(os.environ.get("JOB_WORKERS", "4"))
+JOB_MAX_PENDING = 10000      # New posts and uploads get 503 while this many jobs are waiting
+JOB_MAX_ATTEMPTS = 5
+
+# Fields loaded when a user is only shown as a name and avatar
+USER_SUMMARY_FIELDS = ["name", "username", "profile_picture", "post_count", "follower_count", "following_count"]
+
+# Timeline fan-out tuning
+FANOUT_BATCH_SIZE = 400             # Writes per batch commit, keeping each commit well under Firestore's request size limit
+FANOUT_FOLLOWER_THRESHOLD = 10000   # Authors above this are merged into feeds at read time instead
+TIMELINE_BACKFILL_SIZE = 20         # Recent posts copied into a timeline when following someone
+HIGH_FANOUT_CACHE_TTL = 60          # How long the list of fan-out-on-read authors is reused (seconds)
+FIRESTORE_IN_QUERY_LIMIT = 30       # Maximum values in a Firestore "in" filter
+
+
+class CachedCertsRequest(requests.Request):
+    """Request adapter that caches Google's public signing certs.
+
+    Responses to GET requests are reused until the max-age advertised in the
+    endpoint's Cache-Control header runs out, and all requests share one
+    pooled keep-alive session. If a refresh fails, the last good certs are
+    served instead so a slow Google endpoint doesn't fail every login.
+    """
+
+    def __init__(self):
+        session = Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=16)
+        session.mount("https://", adapter)
+        super().__init__(session=session)
+        self._cache = {}
+        self._lock = threading.Lock()
+
+    def __call__(self, url, method="GET", body=None, headers=None, timeout=CERTS_FETCH_TIMEOUT, **kwargs):
+        if method != "GET":
+            return super().__call__(url, method=method, body=body, headers=headers, timeout=timeout, **kwargs)
+
+        with self._lock:
+            cached = self._cache.get(url)
+            if cached and cached[1] > time.monotonic():
+                return cached[0]
+
+            try:
+                response = super().__call__(url, method=method, body=body, headers=headers, timeout=timeout, **kwargs)
+            except Exception:
+                if cached:
+                    logger.warning("Cert refresh failed, serving stale certs", extra={"fields": {"url": url}})
+                    return cached[0]
+                raise
+
+            if response.status != 200:
+                return cached[0] if cached else response
+
+            # Read the body now so the cached response can be replayed
+            response.data
+            max_age = self._parse_max_age(response.headers.get("Cache-Control", ""))
+            self._cache[url] = (response, time.monotonic() + max_age)
+            return response
+
+    @staticmethod
+    def _parse_max_age(cache_control: str) -> int:
+        match = re.search(r"max-age=(\d+)", cache_control or "")
+        return int(match.group(1)) if match else CERTS_DEFAULT_MAX_AGE
+
+
+class TokenCache:
+    """Thread-safe LRU of verified token claims, keyed by token hash.
+
+    Each entry lives only until the token's own ``exp`` claim, so a cached
+    token is never accepted after Firebase would have rejected it.
+    """
+
+    def __init__(self, max_entries: int = TOKEN_CACHE_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(id_token_str: str) -> str:
+        return hashlib.sha256(id_token_str.encode("utf-8")).hexdigest()
+
+    def get(self, id_token_str: str):
+        key = self._key(id_token_str)
+        with self._lock:
+            entry = self._entries.get(key)
+            if not entry:
+                return None
+            claims, expires_at = entry
+            if expires_at <= time.time():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return claims
+
+    def set(self, id_token_str: str, claims: dict):
+        expires_at = claims.get("exp", 0)
+        if expires_at <= time.time():
+            return
+        key = self._key(id_token_str)
+        with self._lock:
+            self._entries[key] = (claims, expires_at)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+class TaggedCache:
+    """Thread-safe LRU of rendered pages or records, invalidated by tag.
+
+    Each entry is stored with tags naming what it shows ("user:<id>",
+    "post:<id>", "viewer:<id>", ...). Writes call invalidate() with the tags
+    they affect; entries also expire after the TTL as a safety net. A
+    miss takes a version() before reading Firestore and passes it to set(), so
+    a result read before a concurrent invalidation is not cached.
+    """
+
+    def __init__(self, max_entries: int = PAGE_CACHE_MAX_ENTRIES, ttl: float = PAGE_CACHE_TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()   # key -> (value, tags, expires_at)
+        self._keys_by_tag = {}
+        self._invalidated = OrderedDict()   # tag -> (version, time), most recent last
+        self._version = 0
+        self._lock = threading.Lock()
+
+    def version(self) -> int:
+        with self._lock:
+            return self._version
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if not entry:
+                return None
+            if entry[2] <= time.monotonic():
+                self._remove(key)
+                return None
+            self._entries.move_to_end(key)
+            return entry[0]
+
+    def set(self, key, value, tags, since: int):
+        tags = set(tags)
+        with self._lock:
+            if any(self._invalidated.get(tag, (0, 0))[0] > since for tag in tags):
+                return
+            self._remove(key)
+            self._entries[key] = (value, tags, time.monotonic() + self.ttl)
+            for tag in tags:
+                self._keys_by_tag.setdefault(tag, set()).add(key)
+            while len(self._entries) > self.max_entries:
+                self._remove(next(iter(self._entries)))
+
+    def invalidate(self, *tags):
+        now = time.monotonic()
+        with self._lock:
+            self._version += 1
+            for tag in tags:
+                for key in list(self._keys_by_tag.get(tag, ())):
+                    self._remove(key)
+                self._invalidated.pop(tag, None)
+                self._invalidated[tag] = (self._version, now)
+            # A miss takes far less than the TTL, so older invalidations can be forgotten
+            while self._invalidated and next(iter(self._invalidated.values()))[1] < now - self.ttl:
+                self._invalidated.popitem(last=False)
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if not entry:
+            return
+        for tag in entry[1]:
+            keys = self._keys_by_tag.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._keys_by_tag[tag]
+
+
+# ------------------------
+# Helper: Logging + metrics
+# ------------------------
+# Log records are queued and written by a listener thread, so logging never
+# blocks the event loop on stderr. Each line is one JSON object.
+class JSONLogFormatter(logging.Formatter):
+    """Format a record as a JSON object with its message and any "fields" passed in extra"""
+
+    def format(self, record):
+        entry = {
+            "time": datetime.utcfromtimestamp(record.created).isoformat() + "Z",
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        entry.update(getattr(record, "fields", None) or {})
+        return json.dumps(entry, default=str)
+
+logger = logging.getLogger("instagram_replica")
+logger.setLevel(LOG_LEVEL)
+logger.propagate = False
+log_queue = queue.SimpleQueue()
+logger.addHandler(QueueHandler(log_queue))
+_log_output = logging.StreamHandler()
+_log_output.setFormatter(JSONLogFormatter())
+log_listener = QueueListener(log_queue, _log_output)
+log_listener.start()
+atexit.register(log_listener.stop)
+
+class Metrics:
+    """Thread-safe counters and histograms, rendered in the Prometheus text format"""
+
+    def __init__(self):
+        self._kinds = {}        # name -> (kind, help, buckets)
+        self._values = {}       # (name, labels) -> count, or [bucket counts, sum, count]
+        self._lock = threading.Lock()
+
+    def describe(self, name: str, kind: str, help_text: str, buckets=None):
+        self._kinds[name] = (kind, help_text, buckets)
+
+    def inc(self, name: str, amount: float = 1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def observe(self, name: str, value: float, **labels):
+        buckets = self._kinds[name][2]
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [[0] * len(buckets), 0.0, 0]
+            for index, bound in enumerate(buckets):
+                if value <= bound:
+                    entry[0][index] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    @staticmethod
+    def _labels(labels, extra=()):
+        pairs = list(labels) + list(extra)
+        if not pairs:
+            return ""
+        escaped = (
+            f'{key}="{str(value).replace(chr(92), chr(92) * 2).replace(chr(34), chr(92) + chr(34)).replace(chr(10), " ")}"'
+            for key, value in pairs
+        )
+        return "{" + ",".join(escaped) + "}"
+
+    def render(self) -> str:
+        with self._lock:
+            values = sorted(
+                (key, [list(value[0]), value[1], value[2]] if isinstance(value, list) else value)
+                for key, value in self._values.items()
+            )
+        lines = []
+        for name, (kind, help_text, buckets) in self._kinds.items():
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            for (value_name, labels), value in values:
+                if value_name != name:
+                    continue
+                if kind == "counter":
+                    lines.append(f"{name}{self._labels(labels)} {value}")
+                    continue
+                for bound, count in zip(buckets, value[0]):
+                    lines.append(f"{name}_bucket{self._labels(labels, [('le', bound)])} {count}")
+                lines.append(f"{name}_bucket{self._labels(labels, [('le', '+Inf')])} {value[2]}")
+                lines.append(f"{name}_sum{self._labels(labels)} {value[1]}")
+                lines.append(f"{name}_count{self._labels(labels)} {value[2]}")
+        return "\n".join(lines) + "\n"
+
+metrics = Metrics()
+metrics.describe("http_requests_total", "counter", "Requests served, by route and status")
+metrics.describe("http_request_duration_seconds", "histogram", "Time until the last response byte was sent", LATENCY_BUCKETS)
+metrics.describe("http_request_firestore_rpcs", "histogram", "Firestore RPCs made per request", COUNT_BUCKETS)
+metrics.describe("http_request_firestore_reads", "histogram", "Firestore documents read per request", COUNT_BUCKETS)
+metrics.describe("http_request_firestore_writes", "histogram", "Firestore documents written per request", COUNT_BUCKETS)
+metrics.describe("http_request_firestore_bytes_total", "counter", "Firestore message bytes sent and received, by route")
+metrics.describe("firestore_rpcs_total", "counter", "Firestore RPCs, by method")
+metrics.describe("firestore_documents_read_total", "counter", "Firestore documents read")
+metrics.describe("firestore_documents_written_total", "counter", "Firestore documents written")
+metrics.describe("token_verification_seconds", "histogram", "Time spent verifying Firebase ID tokens", LATENCY_BUCKETS)
+metrics.describe("template_render_seconds", "histogram", "Time spent rendering templates", LATENCY_BUCKETS)
+metrics.describe("http_requests_rejected_total", "counter", "Requests refused by rate limits or load shedding, by reason")
+metrics.describe("background_jobs_total", "counter", "Background job attempts, by job and outcome")
+metrics.describe("background_job_duration_seconds", "histogram", "Time taken by each background job attempt", LATENCY_BUCKETS)
+
+def record_job(name: str, outcome: str, seconds: float):
+    """JobQueue observer: count each attempt and how long it took"""
+    metrics.inc("background_jobs_total", job=name, outcome=outcome)
+    metrics.observe("background_job_duration_seconds", seconds, job=name)
+
+# ------------------------
+# Helper: Rate limiting + load shedding
+# ------------------------
+class RateLimiter:
+    """Thread-safe token buckets per (route, user), refilled continuously
+
+    Each route in RATE_LIMITS allows a burst of requests and then a steady
+    rate. The least recently used buckets are dropped beyond max_buckets,
+    which only ever resets a quiet user to a full bucket.
+    """
+
+    def __init__(self, limits: dict, max_buckets: int = RATE_LIMIT_MAX_BUCKETS):
+        self.limits = limits
+        self.max_buckets = max_buckets
+        self._buckets = OrderedDict()   # (route, key) -> (tokens, updated_at)
+        self._lock = threading.Lock()
+
+    def acquire(self, route: str, key: str) -> float:
+        """Take a token, returning 0 if one was available or else the seconds until one will be"""
+        capacity, rate = self.limits[route]
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated_at = self._buckets.get((route, key), (capacity, now))
+            tokens = min(capacity, tokens + (now - updated_at) * rate)
+            wait = 0.0
+            if tokens >= 1:
+                tokens -= 1
+            else:
+                wait = (1 - tokens) / rate
+            self._buckets[(route, key)] = (tokens, now)
+            self._buckets.move_to_end((route, key))
+            while len(self._buckets) > self.max_buckets:
+                self._buckets.popitem(last=False)
+        return wait
+
+class FirestoreOverloaded(Exception):
+    """Raised when a Firestore call is refused because too many are already waiting"""
+
+class FirestoreLimiter:
+    """Track Firestore calls in flight and decide when to shed load
+
+    New requests are turned away while too many calls are pending or while
+    queued calls wait longer than max_queue_wait on average (a moving average
+    that only counts while there is a queue). Calls made by requests already
+    admitted only fail past the hard limit, so finished work isn't wasted.
+    """
+
+    def __init__(self, max_pending: int = FIRESTORE_MAX_PENDING, max_queue_wait: float = FIRESTORE_MAX_QUEUE_WAIT):
+        self.max_pending = max_pending
+        self.max_queue_wait = max_queue_wait
+        self.pending = 0    # Calls submitted and not finished
+        self.running = 0    # Calls that have a worker thread
+        self.average_wait = 0.0
+        self._lock = threading.Lock()
+
+    def overloaded(self) -> Optional[str]:
+        """The reason new requests should be refused right now, if any"""
+        with self._lock:
+            if self.pending >= self.max_pending:
+                return "firestore_queue"
+            if self.pending > self.running and self.average_wait > self.max_queue_wait:
+                return "firestore_latency"
+            return None
+
+    def submit(self):
+        with self._lock:
+            if self.pending >= self.max_pending * FIRESTORE_HARD_LIMIT_FACTOR:
+                raise FirestoreOverloaded()
+            self.pending += 1
+
+    def start(self, waited: float):
+        with self._lock:
+            self.running += 1
+            self.average_wait = 0.8 * self.average_wait + 0.2 * waited
+
+    def stop(self):
+        with self._lock:
+            self.running -= 1
+
+    def finish(self):
+        with self._lock:
+            self.pending -= 1
+            if self.pending <= 0:
+                self.average_wait = 0.0
+
+def enforce_rate_limit(route: str, key: str):
+    """Refuse the request with 429 if the user's bucket for the route is empty"""
+    wait = rate_limiter.acquire(route, key)
+    if wait:
+        metrics.inc("http_requests_rejected_total", reason="rate_limit", route=route)
+        raise HTTPException(
+            status_code=429,
+            detail="Too many requests, please slow down",
+            headers={"Retry-After": str(math.ceil(wait))}
+        )
+
+def overloaded_response(reason: str) -> JSONResponse:
+    metrics.inc("http_requests_rejected_total", reason=reason, route="*")
+    return JSONResponse(
+        status_code=503,
+        content={"detail": "Server is busy, please retry shortly"},
+        headers={"Retry-After": str(SHED_RETRY_AFTER)}
+    )
+
+rate_limiter = RateLimiter(RATE_LIMITS)
+firestore_limiter = FirestoreLimiter()
+
+# Counters for the request being served. run_db copies the context into its
+# worker threads, so Firestore calls made there are charged to the request.
+request_stats = contextvars.ContextVar("request_stats", default=None)
+_request_stats_lock = threading.Lock()
+
+def add_request_stats(**amounts):
+    """Add to the current request's counters, if there is a request"""
+    stats = request_stats.get()
+    if stats is None:
+        return
+    with _request_stats_lock:
+        for key, amount in amounts.items():
+            stats[key] = stats.get(key, 0) + amount
+
+@contextmanager
+def timed(metric: str, stat: str, **labels):
+    """Observe the duration of a block in a histogram and the current request's counters"""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - started
+        metrics.observe(metric, elapsed, **labels)
+        add_request_stats(**{stat: elapsed})
+
+def message_size(message) -> int:
+    """Serialized size of a Firestore request or response, including dict-built requests"""
+    if isinstance(message, dict):
+        return sum(message_size(value) for value in message.values())
+    if isinstance(message, (list, tuple)):
+        return sum(message_size(value) for value in message)
+    if isinstance(message, (str, bytes)):
+        return len(message)
+    message = getattr(message, "_pb", message)
+    return message.ByteSize() if hasattr(message, "ByteSize") else 0
+
+def record_firestore(method: Optional[str] = None, reads: int = 0, writes: int = 0, sent: int = 0, received: int = 0):
+    """Count an RPC (when method is given) and the documents and bytes it moved"""
+    if method:
+        metrics.inc("firestore_rpcs_total", method=method)
+    if reads:
+        metrics.inc("firestore_documents_read_total", reads)
+    if writes:
+        metrics.inc("firestore_documents_written_total", writes)
+    add_request_stats(
+        firestore_rpcs=1 if method else 0, firestore_reads=reads, firestore_writes=writes,
+        firestore_bytes_sent=sent, firestore_bytes_received=received
+    )
+
+class InstrumentedFirestoreAPI:
+    """Wrap the Firestore client's GAPIC API to count RPCs, documents and bytes
+
+    Every read and write the client library makes goes through these methods,
+    whichever helper issued it. Anything not wrapped is passed through.
+    """
+
+    def __init__(self, api):
+        self._api = api
+
+    def __getattr__(self, name):
+        return getattr(self._api, name)
+
+    def batch_get_documents(self, request=None, **kwargs):
+        return self._stream("batch_get_documents", request, kwargs, ("found", "missing"))
+
+    def run_query(self, request=None, **kwargs):
+        return self._stream("run_query", request, kwargs, ("document",))
+
+    def run_aggregation_query(self, request=None, **kwargs):
+        return self._stream("run_aggregation_query", request, kwargs, ("result",))
+
+    def commit(self, request=None, **kwargs):
+        writes = request.get("writes") if isinstance(request, dict) else request.writes
+        return self._unary("commit", request, kwargs, writes=len(writes or ()))
+
+    def begin_transaction(self, request=None, **kwargs):
+        return self._unary("begin_transaction", request, kwargs)
+
+    def rollback(self, request=None, **kwargs):
+        return self._unary("rollback", request, kwargs)
+
+    def _unary(self, method, request, kwargs, writes=0):
+        response = getattr(self._api, method)(request=request, **kwargs)
+        record_firestore(method, writes=writes, sent=message_size(request), received=message_size(response))
+        return response
+
+    def _stream(self, method, request, kwargs, document_fields):
+        record_firestore(method, sent=message_size(request))
+        for response in getattr(self._api, method)(request=request, **kwargs):
+            response_pb = response._pb
+            reads = int(any(response_pb.HasField(field) for field in document_fields))
+            record_firestore(reads=reads, received=response_pb.ByteSize())
+            yield response
+
+class TimedTemplate(jinja2.Template):
+    """Jinja template that records how long each render takes"""
+
+    def render(self, *args, **kwargs):
+        with timed("template_render_seconds", "render_seconds", template=self.name):
+            return super().render(*args, **kwargs)
+
+
 # Firestore setup
 firestore_db = firestore.Client()
-firebase_request_adapter = requests.Request()
+if hasattr(firestore_db, "_firestore_api_internal"):
+    firestore_db._firestore_api_internal = InstrumentedFirestoreAPI(firestore_db._firestore_api)
+firebase_request_adapter = CachedCertsRequest()
+token_cache = TokenCache()
+page_cache = TaggedCache()
+user_cache = TaggedCache(max_entries=USER_CACHE_MAX_ENTRIES, ttl=USER_CACHE_TTL)
+firestore_executor = ThreadPoolExecutor(max_workers=FIRESTORE_MAX_WORKERS, thread_name_prefix="firestore")
+image_executor = None   # Process pool for image resizing, created at startup
+if STORAGE_BACKEND == "gcs":
+    blob_storage = GCSStorage(GCS_BUCKET, signed_url_ttl=SIGNED_URL_TTL, cache_control=MEDIA_CACHE_CONTROL)
+else:
+    blob_storage = LocalStorage(MEDIA_DIR)
+job_queue = JobQueue(
+    JOB_JOURNAL_PATH, workers=JOB_WORKERS, max_pending=JOB_MAX_PENDING,
+    max_attempts=JOB_MAX_ATTEMPTS, observer=record_job
+)
 
 # Static + template setup
 app.mount("/static", StaticFiles(directory="static"), name="static")
 templates = Jinja2Templates(directory="templates")
+templates.env.template_class = TimedTemplate
+
+# ------------------------
+# Helper: HTTP caching + compression
+# ------------------------
+static_pages = {}
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """Whether an If-None-Match header matches an ETag (weak comparison, as RFC 9110 asks)"""
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    candidates = (tag.strip().removeprefix("W/") for tag in if_none_match.split(","))
+    return etag.removeprefix("W/") in candidates
+
+class ConditionalHTMLMiddleware:
+    """Give complete HTML responses an ETag and answer If-None-Match with 304
+
+    Pages are still rendered (the page cache keeps that cheap), but a browser
+    that already has the same HTML gets an empty 304 instead of the body.
+    Streaming responses and responses that set their own ETag are left alone.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["method"] != "GET":
+            return await self.app(scope, receive, send)
+
+        if_none_match = Headers(scope=scope).get("if-none-match")
+        start_message = None
+
+        async def send_with_etag(message):
+            nonlocal start_message
+            if message["type"] == "http.response.start":
+                headers = Headers(raw=message["headers"])
+                if message["status"] == 200 and "etag" not in headers and headers.get("content-type", "").startswith("text/html"):
+                    start_message = message
+                    return
+            elif message["type"] == "http.response.body" and start_message is not None:
+                response_start, start_message = start_message, None
+                if message.get("more_body", False):
+                    await send(response_start)
+                    return await send(message)
+
+                body = message.get("body", b"")
+                etag = f'"{hashlib.sha256(body).hexdigest()[:32]}"'
+                headers = MutableHeaders(raw=response_start["headers"])
+                headers["ETag"] = etag
+                if "cache-control" not in headers:
+                    headers["Cache-Control"] = "private, no-cache"
+                if etag_matches(if_none_match, etag):
+                    del headers["Content-Length"]
+                    del headers["Content-Type"]
+                    response_start["status"] = 304
+                    message = {"type": "http.response.body", "body": b""}
+                await send(response_start)
+                return await send(message)
+            await send(message)
+
+        await self.app(scope, receive, send_with_etag)
+
+def accepted_encoding(accept_encoding: str) -> Optional[str]:
+    """Pick brotli or gzip from an Accept-Encoding header, preferring brotli when installed"""
+    offered = {}
+    for part in accept_encoding.lower().split(","):
+        name, _, params = part.strip().partition(";")
+        quality = 1.0
+        if params.strip().startswith("q="):
+            try:
+                quality = float(params.strip()[2:])
+            except ValueError:
+                quality = 0.0
+        offered[name.strip()] = quality
+    if brotli and offered.get("br", 0) > 0:
+        return "br"
+    if offered.get("gzip", 0) > 0:
+        return "gzip"
+    return None
+
+class CompressionMiddleware:
+    """Compress text responses above COMPRESSION_MIN_SIZE with brotli or gzip
+
+    Images and other already compressed bodies, event streams and responses
+    that already have a Content-Encoding are passed through. A strong ETag is
+    weakened on compressed responses, since the bytes now differ per encoding.
+    """
+
+    def __init__(self, app, minimum_size: int = COMPRESSION_MIN_SIZE):
+        self.app = app
+        self.minimum_size = minimum_size
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        encoding = accepted_encoding(Headers(scope=scope).get("accept-encoding", ""))
+        if not encoding:
+            return await self.app(scope, receive, send)
+
+        start_message = None
+        compress = finish = None
+
+        async def send_compressed(message):
+            nonlocal start_message, compress, finish
+            if message["type"] == "http.response.start":
+                start_message = message
+                return
+            if message["type"] != "http.response.body":
+                return await send(message)
+
+            body = message.get("body", b"")
+            more_body = message.get("more_body", False)
+            if start_message is not None:
+                response_start, start_message = start_message, None
+                headers = MutableHeaders(raw=response_start["headers"])
+                content_type = headers.get("content-type", "")
+                if (
+                    "content-encoding" not in headers
+                    and content_type.startswith(COMPRESSIBLE_TYPES)
+                    and not content_type.startswith("text/event-stream")
+                    and (more_body or len(body) >= self.minimum_size)
+                ):
+                    if encoding == "br":
+                        compressor = brotli.Compressor(quality=BROTLI_QUALITY)
+                        compress, finish = compressor.process, compressor.finish
+                    else:
+                        compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31)
+                        compress, finish = compressor.compress, compressor.flush
+                    headers["Content-Encoding"] = encoding
+                    headers.add_vary_header("Accept-Encoding")
+                    if headers.get("etag", "").startswith('"'):
+                        headers["ETag"] = "W/" + headers["etag"]
+                    del headers["Content-Length"]
+                    if not more_body:
+                        body = compress(body) + finish()
+                        headers["Content-Length"] = str(len(body))
+                        compress = None
+                    else:
+                        body = compress(body)
+                    message = {**message, "body": body}
+                await send(response_start)
+                return await send(message)
+
+            if compress:
+                body = compress(body) + (b"" if more_body else finish())
+                message = {**message, "body": body}
+            await send(message)
+
+        await self.app(scope, receive, send_compressed)
+
+app.add_middleware(ConditionalHTMLMiddleware)
+app.add_middleware(CompressionMiddleware)
+
+def load_static_pages():
+    """Read the pages that don't need rendering into memory once"""
+    for name, path in STATIC_PAGES.items():
+        with open(path, encoding="utf-8") as page_file:
+            static_pages[name] = page_file.read()
+
+# ------------------------
+# Helper: Uploads
+# ------------------------
+# Leading bytes of the image formats we accept, mapped to their extension
+IMAGE_SIGNATURES = {
+    b"\xff\xd8\xff": ".jpg",
+    b"\x89PNG\r\n\x1a\n": ".png",
+    b"GIF87a": ".gif",
+    b"GIF89a": ".gif",
+}
+
+class UploadSizeLimitMiddleware:
+    """Reject upload requests whose body is larger than an image upload can be
+
+    Requests with a Content-Length over the limit are refused up front. Bodies
+    without one are counted as they are received.
+    """
+
+    def __init__(self, app, max_body_bytes: int = UPLOAD_MAX_BYTES + UPLOAD_FORM_OVERHEAD):
+        self.app = app
+        self.max_body_bytes = max_body_bytes
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["method"] != "POST" or scope["path"] not in UPLOAD_PATHS:
+            return await self.app(scope, receive, send)
+
+        headers = dict(scope["headers"])
+        content_length = headers.get(b"content-length")
+        if content_length and content_length.isdigit() and int(content_length) > self.max_body_bytes:
+            response = JSONResponse(status_code=413, content={"detail": "Upload too large"})
+            return await response(scope, receive, send)
+
+        received = 0
+
+        async def limited_receive():
+            nonlocal received
+            message = await receive()
+            received += len(message.get("body", b""))
+            if received > self.max_body_bytes:
+                raise HTTPException(status_code=413, detail="Upload too large")
+            return message
+
+        await self.app(scope, limited_receive, send)
+
+app.add_middleware(UploadSizeLimitMiddleware)
+
+def route_label(scope) -> str:
+    """Name a request by its route template, so metrics don't grow with every ID"""
+    route_path = getattr(scope.get("route"), "path", None)
+    if route_path:
+        return route_path
+    if scope["path"].startswith("/static/"):
+        return "/static"
+    return "unmatched"
+
+class RequestMetricsMiddleware:
+    """Record each request's latency, Firestore usage and render time
+
+    Latency runs until the last response byte is sent. Background jobs run
+    outside any request and aren't charged to the one that enqueued them.
+    Requests slower than SLOW_REQUEST_MS are logged with their counters.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        stats = {}
+        stats_token = request_stats.set(stats)
+        started = time.perf_counter()
+        finished = None
+        status_code = 500
+
+        async def send_with_timing(message):
+            nonlocal finished, status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            elif message["type"] == "http.response.body" and not message.get("more_body", False):
+                finished = time.perf_counter()
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            request_stats.reset(stats_token)
+            duration = (finished or time.perf_counter()) - started
+            self.record(scope, status_code, duration, stats)
+
+    @staticmethod
+    def record(scope, status_code: int, duration: float, stats: dict):
+        route, method = route_label(scope), scope["method"]
+        metrics.inc("http_requests_total", method=method, route=route, status=status_code)
+        metrics.observe("http_request_duration_seconds", duration, method=method, route=route)
+        metrics.observe("http_request_firestore_rpcs", stats.get("firestore_rpcs", 0), route=route)
+        metrics.observe("http_request_firestore_reads", stats.get("firestore_reads", 0), route=route)
+        metrics.observe("http_request_firestore_writes", stats.get("firestore_writes", 0), route=route)
+        metrics.inc("http_request_firestore_bytes_total", stats.get("firestore_bytes_sent", 0), route=route, direction="sent")
+        metrics.inc("http_request_firestore_bytes_total", stats.get("firestore_bytes_received", 0), route=route, direction="received")
+
+        if SLOW_REQUEST_MS and duration * 1000 >= SLOW_REQUEST_MS:
+            fields = {
+                "method": method,
+                "path": scope["path"],
+                "route": route,
+                "status": status_code,
+                "duration_ms": round(duration * 1000, 1),
+            }
+            fields.update({key: round(value, 4) if isinstance(value, float) else value for key, value in stats.items()})
+            logger.warning("Slow request", extra={"fields": fields})
+
+class LoadSheddingMiddleware:
+    """Answer new requests with 503 and Retry-After while Firestore calls are backed up"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http" and not scope["path"].startswith(UNGUARDED_PATH_PREFIXES):
+            reason = firestore_limiter.overloaded()
+            if reason:
+                return await overloaded_response(reason)(scope, receive, send)
+        await self.app(scope, receive, send)
+
+app.add_middleware(LoadSheddingMiddleware)
+app.add_middleware(RequestMetricsMiddleware)
+
+@app.exception_handler(FirestoreOverloaded)
+async def handle_firestore_overloaded(request: Request, exc: FirestoreOverloaded):
+    return overloaded_response("firestore_hard_limit")
+
+def detect_image_type(head: bytes) -> Optional[str]:
+    """Return the file extension for an image's leading bytes, or None if unsupported"""
+    for signature, extension in IMAGE_SIGNATURES.items():
+        if head.startswith(signature):
+            return extension
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return ".webp"
+    return None
+
+def blob_url(blob_name: str) -> str:
+    """URL the /media route serves a blob from"""
+    return f"{MEDIA_URL_PREFIX}/{blob_name}"
+
+async def save_upload(upload) -> str:
+    """Stream an uploaded image into the blob store and return its blob name
+
+    The spooled upload is copied in UPLOAD_CHUNK_SIZE pieces on a worker thread
+    into a temporary file while its SHA-256 is computed. The file is then handed
+    to the storage backend under a name made from the digest, so an image that
+    is already stored is dropped instead of being written again. Uploads over
+    UPLOAD_MAX_BYTES or that aren't a JPEG, PNG, GIF or WebP image are rejected.
+    """
+    if upload.content_type and not upload.content_type.startswith("image/"):
+        raise HTTPException(status_code=400, detail="Only image uploads are allowed")
+    if upload.size is not None and upload.size > UPLOAD_MAX_BYTES:
+        raise HTTPException(status_code=413, detail="Image is too large")
+
+    fd, temp_path = await run_in_threadpool(
+        tempfile.mkstemp, dir=blob_storage.staging_dir, prefix=".upload-", suffix=".tmp"
+    )
+    try:
+        written = 0
+        extension = None
+        digest = hashlib.sha256()
+        with os.fdopen(fd, "wb") as temp_file:
+            while True:
+                chunk = await upload.read(UPLOAD_CHUNK_SIZE)
+                if not chunk:
+                    break
+                if written == 0:
+                    extension = detect_image_type(chunk)
+                    if not extension:
+                        raise HTTPException(status_code=400, detail="Unsupported image format")
+                written += len(chunk)
+                if written > UPLOAD_MAX_BYTES:
+                    raise HTTPException(status_code=413, detail="Image is too large")
+                digest.update(chunk)
+                await run_in_threadpool(temp_file.write, chunk)
+
+        if written == 0:
+            raise HTTPException(status_code=400, detail="Image file is empty")
+
+        blob_name = f"{digest.hexdigest()}{extension}"
+        await run_in_threadpool(blob_storage.put, temp_path, blob_name, mimetypes.guess_type(blob_name)[0])
+        return blob_name
+    except BaseException:
+        await run_in_threadpool(lambda: os.path.exists(temp_path) and os.remove(temp_path))
+        raise
+    finally:
+        await upload.close()
+
+async def build_image_variants(blob_name: str):
+    """Generate the resized variants of a stored image in the process pool
+
+    The source is fetched from storage into a scratch directory, resized there
+    and each variant is stored as a blob named after the source. Returns a
+    mapping of variant name to {"url", "width", "height"}.
+    """
+    base_name = os.path.splitext(blob_name)[0]
+    loop = asyncio.get_running_loop()
+    work_dir = await run_in_threadpool(tempfile.mkdtemp, prefix="variants-")
+    try:
+        source_path = await run_in_threadpool(blob_storage.fetch, blob_name, work_dir)
+        variants = await loop.run_in_executor(
+            image_executor, generate_image_variants, source_path, work_dir, base_name
+        )
+        image_variants = {}
+        for name, variant in variants.items():
+            variant_name = os.path.basename(variant["path"])
+            await run_in_threadpool(blob_storage.put, variant["path"], variant_name, "image/jpeg")
+            image_variants[name] = {"url": blob_url(variant_name), "width": variant["width"], "height": variant["height"]}
+        return image_variants
+    finally:
+        await run_in_threadpool(shutil.rmtree, work_dir, ignore_errors=True)
+
+async def process_post_image(post_id: str, blob_name: str):
+    """Background job: build a post image's variants and record them on the post"""
+    image_variants = await build_image_variants(blob_name)
+    await run_db(firestore_db.collection("posts").document(post_id).update, {"image_variants": image_variants})
+    invalidate_cached(f"post:{post_id}")
+
+async def process_profile_picture(user_id: str, blob_name: str):
+    """Background job: build a profile picture's variants and switch the avatar to the thumbnail"""
+    image_variants = await build_image_variants(blob_name)
+    user_ref = firestore_db.collection("users").document(user_id)
+
+    # Skip the switch if a newer picture was uploaded in the meantime
+    user_doc = await run_db(user_ref.get, field_paths=["profile_picture"])
+    if (user_doc.to_dict() or {}).get("profile_picture") != blob_url(blob_name):
+        return
+    await run_db(user_ref.update, {
+        "profile_picture": image_variants["thumb"]["url"],
+        "profile_picture_original": blob_url(blob_name),
+        "profile_picture_variants": image_variants
+    })
+    invalidate_cached(f"user:{user_id}")
+
+def image_srcset(image_variants: Optional[dict]) -> Optional[str]:
+    """Build an img srcset value from an image's variants"""
+    if not image_variants:
+        return None
+    urls_by_width = {}
+    for variant in image_variants.values():
+        urls_by_width.setdefault(variant["width"], variant["url"])
+    return ", ".join(f"{url} {width}w" for width, url in sorted(urls_by_width.items()))
 
 # ------------------------
 # Helper: Auth + Firestore
 # ------------------------
+async def run_db(func, *args, **kwargs):
+    """Run a blocking Firestore call on the bounded executor and await its result"""
+    loop = asyncio.get_running_loop()
+    # Run in a copy of the caller's context, so the call is counted against its request
+    context = contextvars.copy_context()
+    firestore_limiter.submit()
+    submitted = time.perf_counter()
+
+    def call():
+        firestore_limiter.start(time.perf_counter() - submitted)
+        try:
+            return context.run(func, *args, **kwargs)
+        finally:
+            firestore_limiter.stop()
+
+    try:
+        return await loop.run_in_executor(firestore_executor, call)
+    finally:
+        firestore_limiter.finish()
+
+async def stream_docs(query):
+    """Stream a Firestore query off the event loop and return the snapshots"""
+    return await run_db(lambda: list(query.stream()))
+
 async def get_auth_token(request: Request, token: Optional[str] = Cookie(None)):
     """Extract the authentication token from either cookies or Authorization header"""
     # First try to get from Authorization header
@@ -41,42 +1126,87 @@ async def get_auth_token(request: Request, token: Optional[str] = Cookie(None)):
     # If we can't find a token, return None instead of raising an exception
     return None
 
-def get_user_by_id(user_id: str):
-    """Get a user by their ID"""
-    try:
-        user_ref = firestore_db.collection("users").document(user_id)
-        user_doc = user_ref.get()
-        
-        if not user_doc.exists:
-            raise HTTPException(status_code=404, detail=f"User with ID {user_id} not found")
-        
-        user_data = user_doc.to_dict()
-        user_data["id"] = user_id
-        
-        # Initialize arrays if they don't exist
-        if "followers" not in user_data:
-            user_data["followers"] = []
-        if "following" not in user_data:
-            user_data["following"] = []
-            
-        return user_data
-    except Exception as e:
-        print(f"Error in get_user_by_id: {e}")
-        raise HTTPException(status_code=500, detail=f"Error retrieving user: {str(e)}")
+def invalidate_cached(*tags):
+    """Drop cached pages and user records tagged with any of the given tags"""
+    page_cache.invalidate(*tags)
+    user_cache.invalidate(*tags)
+
+def watch_user_changes():
+    """Listen for user document changes and drop their cached records and pages
+
+    Keeps caches fresh across instances without waiting for the TTL. The first
+    snapshot delivers every user document, so it costs a read per user on
+    startup and is only enabled with USER_CACHE_LISTENER=1.
+    """
+    def on_snapshot(_, changes, __):
+        for change in changes:
+            invalidate_cached(f"user:{change.document.id}")
+    return firestore_db.collection("users").on_snapshot(on_snapshot)
+
+def cache_user_summaries(users: List[dict], since: int):
+    """Store user summaries read since the given cache version"""
+    for user in users:
+        summary = {field: user[field] for field in USER_SUMMARY_FIELDS if field in user}
+        user_cache.set(("summary", user["id"]), summary, [f"user:{user['id']}"], since)
+
+def get_user_summaries(user_ids) -> dict:
+    """Return compact user summaries keyed by user ID, reading only cache misses
+
+    Misses are fetched in one batched read limited to USER_SUMMARY_FIELDS.
+    Missing users are left out of the result.
+    """
+    summaries = {}
+    missing_ids = []
+    for user_id in dict.fromkeys(user_id for user_id in user_ids if user_id):
+        summary = user_cache.get(("summary", user_id))
+        if summary is None:
+            missing_ids.append(user_id)
+        else:
+            summaries[user_id] = dict(summary)
+
+    if missing_ids:
+        version = user_cache.version()
+        fetched = get_users_by_ids(missing_ids, USER_SUMMARY_FIELDS)
+        cache_user_summaries([{**user, "id": user_id} for user_id, user in fetched.items()], version)
+        summaries.update(fetched)
+    return summaries
+
+def get_users_by_ids(user_ids, fields: Optional[List[str]] = None):
+    """Fetch several users in one batched read, keyed by user ID
+
+    Only the given fields are transferred when a field mask is passed. Missing
+    users are left out of the result.
+    """
+    unique_ids = list(dict.fromkeys(user_id for user_id in user_ids if user_id))
+    if not unique_ids:
+        return {}
+
+    user_refs = [firestore_db.collection("users").document(user_id) for user_id in unique_ids]
+    users = {}
+    for user_doc in firestore_db.get_all(user_refs, field_paths=fields):
+        if user_doc.exists:
+            users[user_doc.id] = user_doc.to_dict()
+    return users
 
 def get_user_from_token(id_token_str: str):
     """Verify Firebase ID token and retrieve user information"""
     if not id_token_str:
-        print("No token provided to get_user_from_token")
+        logger.info("No token provided to get_user_from_token")
         return None
         
     try:
-        # Verify the Firebase ID token using Google's OAuth2
-        claims = google.oauth2.id_token.verify_firebase_token(id_token_str, firebase_request_adapter)
-        
+        # Reuse claims from an earlier verification of the same token
+        claims = token_cache.get(id_token_str)
         if not claims:
-            print("Failed to verify token: Claims is empty")
-            return None
+            # Verify the Firebase ID token using Google's OAuth2
+            with timed("token_verification_seconds", "token_seconds"):
+                claims = google.oauth2.id_token.verify_firebase_token(id_token_str, firebase_request_adapter)
+
+            if not claims:
+                logger.warning("Failed to verify token: claims are empty")
+                return None
+
+            token_cache.set(id_token_str, claims)
 
         # Token expiration time and grace period (e.g., 5 minutes)
         expiration_time = datetime.utcfromtimestamp(claims.get("exp", 0))
@@ -85,41 +1215,57 @@ def get_user_from_token(id_token_str: str):
 
         # If the token is within the grace period of expiration, allow it
         if not (current_time < expiration_time + grace_period):
-            print("Token expired")
+            logger.info("Token expired")
             return None
 
         # Different Firebase implementations might use different claim keys
         user_id = claims.get("user_id") or claims.get("sub") or claims.get("uid")
         if not user_id:
-            print("No user ID found in token claims")
-            print(f"Available claims: {claims}")
+            logger.warning("No user ID found in token claims", extra={"fields": {"claim_names": sorted(claims)}})
             return None
             
+        # Reuse the signed-in user's record until a write or the TTL drops it
+        cached_user = user_cache.get(("account", user_id))
+        if cached_user is not None:
+            return dict(cached_user)
+
         # Try to get user from Firestore, create if it doesn't exist
+        version = user_cache.version()
         user_doc_ref = firestore_db.collection("users").document(user_id)
         user_doc = user_doc_ref.get()
 
         if user_doc.exists:
             user_data = user_doc.to_dict()
             user_data["id"] = user_id
-            
-            # Make sure arrays exist
-            if "followers" not in user_data:
-                user_doc_ref.update({"followers": []})
-                user_data["followers"] = []
-            if "following" not in user_data:
-                user_doc_ref.update({"following": []})
-                user_data["following"] = []
-                
-            return user_data
+
+            # Index users created before prefix search existed, and move users still
+            # on follower/following arrays or without a post count to edges and
+            # counts, in a single update
+            search_index = {}
+            if "name_lower" not in user_data:
+                search_index = search_fields(user_data.get("name"), user_data.get("username"))
+            if needs_count_migration(user_data):
+                user_data = migrate_follow_graph(user_id, user_data, search_index)
+            elif search_index:
+                user_doc_ref.update(search_index)
+                user_data.update(search_index)
+
+            user_cache.set(("account", user_id), user_data, [f"user:{user_id}"], version)
+            return dict(user_data)
         else:
-            # Create new user document with initialized arrays
+            # Create new user document with initialized counts
+            name = claims.get("name", claims.get("email", "").split('@')[0])
             new_user = {
-                "name": claims.get("name", claims.get("email", "").split('@')[0]),
+                "name": name,
+                **search_fields(name, None),
                 "email": claims.get("email", ""),
                 "created_at": datetime.utcnow().isoformat(),
-                "followers": [],
-                "following": []
+                "follower_count": 0,
+                "following_count": 0,
+                "post_count": 0,
+                "follow_edges_migrated": True,
+                "follow_graph_migrated": True,
+                "timeline_backfilled": True
             }
             user_doc_ref.set(new_user)
             
@@ -129,10 +1275,10 @@ def get_user_from_token(id_token_str: str):
 
     except ValueError as e:
         # This happens if the token is invalid
-        print(f"Token validation error: {e}")
+        logger.info("Token validation error", extra={"fields": {"error": str(e)}})
         return None
-    except Exception as e:
-        print(f"Error verifying token or fetching user: {e}")
+    except Exception:
+        logger.exception("Error verifying token or fetching user")
         return None
 
 # Dependency to get the current user (optional)
@@ -141,7 +1287,7 @@ async def get_current_user(request: Request, token: Optional[str] = Cookie(None)
     if not token_str:
         return None
     
-    return get_user_from_token(token_str)
+    return await run_db(get_user_from_token, token_str)
 
 # Dependency to get the current user (required)
 async def get_required_user(request: Request, token: Optional[str] = Cookie(None)):
@@ -153,7 +1299,7 @@ async def get_required_user(request: Request, token: Optional[str] = Cookie(None
             headers={"WWW-Authenticate": "Bearer"},
         )
     
-    user_data = get_user_from_token(token_str)
+    user_data = await run_db(get_user_from_token, token_str)
     if not user_data:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
@@ -163,42 +1309,953 @@ async def get_required_user(request: Request, token: Optional[str] = Cookie(None
     
     return user_data
 
-# -------------------
-# FastAPI Routes
-# -------------------
+# ------------------------
+# Helper: Page cache
+# ------------------------
+def render_page(template_name: str, context: dict) -> str:
+    """Render a template to a string so the result can be cached"""
+    return templates.get_template(template_name).render(context)
 
-@app.get("/")
-async def serve_home(request: Request, user_data = Depends(get_current_user)):
-    """Home page route - if not authenticated, redirect to login"""
-    # If user is not authenticated, redirect to login page
-    if not user_data:
-        return RedirectResponse(url="/login", status_code=302)
-    
-    user_id = user_data["id"]
-    
-    # Fetch feed posts (this is a placeholder - you might want to fetch posts from users that the current user follows)
-    posts_ref = firestore_db.collection("posts").order_by("date", direction=firestore.Query.DESCENDING).limit(10)
-    posts = []
-    
-    for post_doc in posts_ref.stream():
-        post = post_doc.to_dict()
-        
-        # Fetch user information for each post
+async def get_or_build(key, build):
+    """Return the cached value for key, or await build() for (value, tags) and cache it"""
+    value = page_cache.get(key)
+    if value is None:
+        version = page_cache.version()
+        value, tags = await build()
+        page_cache.set(key, value, tags, version)
+    return value
+
+def post_tags(posts: List[dict]) -> List[str]:
+    """Cache tags for the posts shown on a page and their authors"""
+    return [f"post:{post['id']}" for post in posts] + [f"user:{post.get('user_id')}" for post in posts]
+
+# ------------------------
+# Helper: JSON API
+# ------------------------
+# /api/v1 routes return compact JSON for API clients. A "fields" parameter
+# picks which fields come back and becomes the Firestore field mask, so
+# unrequested fields are never read. Bodies are cached like pages and carry
+# an ETag, and a matching If-None-Match gets an empty 304.
+def parse_api_fields(fields: Optional[str], allowed, default) -> List[str]:
+    """Turn a comma-separated fields parameter into a list of allowed field names"""
+    if not fields:
+        return list(default)
+    requested = [field.strip() for field in fields.split(",") if field.strip() and field.strip() != "id"]
+    unknown = sorted(set(requested) - set(allowed))
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Unknown fields: {', '.join(unknown)}")
+    return list(dict.fromkeys(requested))
+
+def project(record: dict, fields: List[str]) -> dict:
+    """Keep only the record's ID and the requested fields"""
+    return {"id": record["id"], **{field: record[field] for field in fields if field in record}}
+
+def post_read_fields(post_fields: List[str], *extra: str) -> List[str]:
+    """Fields to read for API posts: extra, the requested ones and, for author names, user_id"""
+    fields = list(extra) + post_fields
+    if "user_name" in post_fields:
+        fields.append("user_id")
+    return list(dict.fromkeys(fields))
+
+async def fill_author_names(posts: List[dict], post_fields: List[str]):
+    """Replace the name copied onto each post with its author's current one, if it was asked for"""
+    if "user_name" not in post_fields or not posts:
+        return
+    authors = await run_db(get_user_summaries, [post.get("user_id") for post in posts])
+    for post in posts:
+        author = authors.get(post.get("user_id"))
+        if author:
+            post["user_name"] = author.get("name", "")
+
+def api_body(content) -> bytes:
+    """Serialize an API response as compact JSON"""
+    return json.dumps(jsonable_encoder(content), separators=(",", ":"), ensure_ascii=False).encode("utf-8")
+
+def api_response(request: Request, body: bytes) -> Response:
+    """Send a cached API body with an ETag, or 304 if the client already has it"""
+    etag = f'"{hashlib.sha256(body).hexdigest()[:32]}"'
+    headers = {"ETag": etag, "Cache-Control": "private, no-cache"}
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers=headers)
+    return Response(body, media_type="application/json", headers=headers)
+
+async def get_api_user(user_id: str, fields: List[str]) -> dict:
+    """Read a user for the API with a field mask, migrating legacy follow data first"""
+    stored_fields = [field for field in fields if field != "is_following"]
+    users = await run_db(get_users_by_ids, [user_id], list(dict.fromkeys(stored_fields + ["post_count", "follow_graph_migrated"])))
+    if user_id not in users:
+        raise HTTPException(status_code=404, detail=f"User with ID {user_id} not found")
+    user = users[user_id]
+    if needs_count_migration(user):
+        user = await run_db(migrate_follow_graph, user_id) or user
+    return {**user, "id": user_id}
+
+# ------------------------
+# Helper: Live events
+# ------------------------
+# Writes publish small events (new comments, posts and follows) to topics
+# such as "post:<id>", "feed:<user id>" and "user:<user id>", and every open
+# /events stream subscribed to a topic receives them. Delivery is in-process,
+# so a stream only sees writes handled by the same instance.
+class EventSubscription:
+    """One event stream's topics and its bounded queue of formatted messages"""
+
+    def __init__(self, topics, queue_size: int):
+        self.topics = set(topics)
+        self.queue = asyncio.Queue(maxsize=queue_size)
+        self.overflowed = False
+
+class EventBroker:
+    """In-process publish/subscribe for event streams
+
+    Publishing never waits on a subscriber. A subscriber whose queue is full
+    has fallen behind, so it is dropped; its stream ends and the browser
+    reconnects. Only use it from the event loop thread.
+    """
+
+    def __init__(self, queue_size: int = EVENT_QUEUE_SIZE):
+        self.queue_size = queue_size
+        self._subscribers = {}   # topic -> set of subscriptions
+
+    def subscribe(self, topics) -> EventSubscription:
+        subscription = EventSubscription(topics, self.queue_size)
+        for topic in subscription.topics:
+            self._subscribers.setdefault(topic, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription: EventSubscription):
+        for topic in subscription.topics:
+            subscribers = self._subscribers.get(topic)
+            if subscribers is not None:
+                subscribers.discard(subscription)
+                if not subscribers:
+                    del self._subscribers[topic]
+
+    def publish(self, topics, event: str, data: dict):
+        """Send an event to every subscriber of any of the topics, once each"""
+        subscriptions = set()
+        for topic in topics:
+            subscriptions.update(self._subscribers.get(topic, ()))
+        if not subscriptions:
+            return
+        message = f"event: {event}\ndata: {json.dumps(data, default=str)}\n\n"
+        for subscription in subscriptions:
+            try:
+                subscription.queue.put_nowait(message)
+            except asyncio.QueueFull:
+                subscription.overflowed = True
+                self.unsubscribe(subscription)
+
+event_broker = EventBroker()
+
+async def event_stream(topics):
+    """Yield server-sent event messages for the topics, with heartbeats while idle"""
+    subscription = event_broker.subscribe(topics)
+    try:
+        yield f"retry: {EVENT_RETRY_MS}\n\n"
+        while not subscription.overflowed:
+            try:
+                message = await asyncio.wait_for(subscription.queue.get(), EVENT_HEARTBEAT_INTERVAL)
+            except asyncio.TimeoutError:
+                message = ": heartbeat\n\n"
+            yield message
+    finally:
+        event_broker.unsubscribe(subscription)
+
+# ------------------------
+# Helper: Pagination
+# ------------------------
+# Lists are paged with opaque cursors encoding the (date, id) of the last item
+# on the previous page. Queries order by date then document ID, both
+# descending, and resume with start_after so no offset scans are needed.
+def encode_cursor(sort_value: str, doc_id: str) -> str:
+    """Encode the (sort value, id) of the last item on a page as an opaque cursor"""
+    raw = json.dumps([sort_value, doc_id]).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+def decode_cursor(cursor: Optional[str], sort_field: str = "date"):
+    """Decode a page cursor into start_after values, or None for the first page"""
+    if not cursor:
+        return None
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        sort_value, doc_id = json.loads(raw)
+        return {sort_field: sort_value, "__name__": doc_id}
+    except Exception:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+def next_cursor_for(posts: List[dict], limit: int) -> Optional[str]:
+    """Return the cursor for the page after posts, or None if this was the last page"""
+    if len(posts) < limit:
+        return None
+    return encode_cursor(posts[-1].get("date", ""), posts[-1]["id"])
+
+def paginate_by_date(query, limit: int, cursor: Optional[dict] = None):
+    """Order a query newest first with a stable tie-breaker and apply the cursor"""
+    query = query.order_by("date", direction=firestore.Query.DESCENDING).order_by(
+        "__name__", direction=firestore.Query.DESCENDING
+    )
+    if cursor:
+        query = query.start_after(cursor)
+    return query.limit(limit)
+
+def get_profile_posts(user_id: str, limit: int = PROFILE_PAGE_SIZE, cursor: Optional[dict] = None, fields: Optional[List[str]] = None):
+    """Return one page of a user's posts, newest first
+
+    Needs the posts (user_id, date) index in firestore.indexes.json. With fields, only those fields are read and the posts are returned as stored.
+    """
+    posts_ref = paginate_by_date(firestore_db.collection("posts").where("user_id", "==", user_id), limit, cursor)
+    if fields is not None:
+        return [{**post_doc.to_dict(), "id": post_doc.id} for post_doc in posts_ref.select(fields).stream()]
+    return [post_from_doc(post_doc) for post_doc in posts_ref.stream()]
+
+# ------------------------
+# Helper: Comments
+# ------------------------
+# Each comment is a document in posts/{post_id}/comments. The post itself only
+# carries comment_count and latest_comments, the newest COMMENT_PREVIEW_SIZE
+# comments, so feed and profile reads stay small however busy a post gets.
+# Older posts may still hold every comment in a "comments" array; those are
+# moved into the subcollection the first time the post is commented on or its
+# older comments are paged.
+def comments_ref(post_id: str):
+    """Return the comments subcollection of a post"""
+    return firestore_db.collection("posts").document(post_id).collection("comments")
+
+def legacy_comments(post: dict) -> List[dict]:
+    """Give comments from a post's legacy array the IDs they are migrated under"""
+    return [{**comment, "id": f"legacy-{index:05d}"} for index, comment in enumerate(post.get("comments") or [])]
+
+def post_from_doc(post_doc) -> dict:
+    """Convert a post snapshot to a dict with its ID and comment preview"""
+    post = {**post_doc.to_dict(), "id": post_doc.id}
+    if "comment_count" not in post:
+        comments = legacy_comments(post)
+        post["comment_count"] = len(comments)
+        post["latest_comments"] = comments[-COMMENT_PREVIEW_SIZE:]
+    post.pop("comments", None)
+
+    # Responsive image sources, once the background resize has finished
+    image_variants = post.get("image_variants") or {}
+    post["image_srcset"] = image_srcset(image_variants)
+    post["thumbnail_url"] = image_variants.get("thumb", {}).get("url") or post.get("image_url")
+
+    # Cursor for loading the comments older than the preview
+    post["comments_cursor"] = None
+    preview = post.get("latest_comments") or []
+    if post["comment_count"] > len(preview):
+        post["comments_cursor"] = encode_cursor(preview[0]["date"], preview[0]["id"])
+    return post
+
+def migrate_legacy_comments(transaction, post_ref, post: dict):
+    """Move a post's legacy comments array into its subcollection within a transaction
+
+    Returns the post fields that replace the array.
+    """
+    comments = legacy_comments(post)
+    for comment in comments:
+        comment_data = {key: value for key, value in comment.items() if key != "id"}
+        transaction.set(post_ref.collection("comments").document(comment["id"]), comment_data)
+    return {
+        "comments": firestore.DELETE_FIELD,
+        "comment_count": len(comments),
+        "latest_comments": comments[-COMMENT_PREVIEW_SIZE:]
+    }
+
+@firestore.transactional
+def add_comment_in_transaction(transaction, post_ref, comment: dict):
+    """Write a comment and update the post's count and preview atomically
+
+    Returns the comment with its ID and the post's new comment count.
+    """
+    post_doc = post_ref.get(field_paths=["comment_count", "latest_comments", "comments"], transaction=transaction)
+    if not post_doc.exists:
+        raise HTTPException(status_code=404, detail="Post not found")
+    post = post_doc.to_dict()
+
+    post_update = {}
+    if "comment_count" not in post:
+        post_update = migrate_legacy_comments(transaction, post_ref, post)
+        post.update(post_update)
+
+    comment_ref = post_ref.collection("comments").document()
+    transaction.set(comment_ref, {**comment, "created_at": firestore.SERVER_TIMESTAMP})
+    post_update["comment_count"] = post.get("comment_count", 0) + 1
+    post_update["latest_comments"] = (post.get("latest_comments", []) + [{**comment, "id": comment_ref.id}])[-COMMENT_PREVIEW_SIZE:]
+    transaction.update(post_ref, post_update)
+    return {**comment, "id": comment_ref.id}, post_update["comment_count"]
+
+@firestore.transactional
+def migrate_legacy_comments_in_transaction(transaction, post_ref):
+    """Migrate a post's legacy comments array if it still has one"""
+    post_doc = post_ref.get(transaction=transaction)
+    if not post_doc.exists:
+        raise HTTPException(status_code=404, detail="Post not found")
+    post = post_doc.to_dict()
+    if "comment_count" not in post:
+        transaction.update(post_ref, migrate_legacy_comments(transaction, post_ref, post))
+
+def get_comments_page(post_id: str, limit: int = COMMENT_PAGE_SIZE, cursor: Optional[dict] = None):
+    """Return one page of a post's comments, newest first, older than the cursor"""
+    post_ref = firestore_db.collection("posts").document(post_id)
+    post_doc = post_ref.get(field_paths=["comment_count"])
+    if not post_doc.exists:
+        raise HTTPException(status_code=404, detail="Post not found")
+    if "comment_count" not in post_doc.to_dict():
+        migrate_legacy_comments_in_transaction(firestore_db.transaction(), post_ref)
+
+    comments_query = paginate_by_date(comments_ref(post_id), limit, cursor)
+    return [{**comment_doc.to_dict(), "id": comment_doc.id} for comment_doc in comments_query.stream()]
+
+# ------------------------
+# Helper: Likes
+# ------------------------
+# A like is an edge document posts/{post_id}/likes/{user_id}, which makes
+# liking idempotent. Unliking keeps the edge with liked set to False, so it
+# also remembers that the user liked the post once and only the first like
+# counts towards trending. The count is spread over LIKE_SHARD_COUNT shard documents
+# in posts/{post_id}/like_shards so a viral post never exceeds Firestore's
+# per-document write rate. Posts whose shards changed are remembered and their
+# total is written back to the post's "likes" field every LIKE_FLUSH_INTERVAL
+# seconds, so feeds read the count for free.
+_dirty_like_posts = set()
+_dirty_like_posts_lock = threading.Lock()
+
+def like_ref(post_id: str, user_id: str):
+    """Return the like edge for a user and a post"""
+    return firestore_db.collection("posts").document(post_id).collection("likes").document(user_id)
+
+def like_shard_ref(post_id: str, shard: int):
+    """Return one of a post's like counter shards"""
+    return firestore_db.collection("posts").document(post_id).collection("like_shards").document(str(shard))
+
+@firestore.transactional
+def set_like_in_transaction(transaction, post_id: str, user_id: str, liked: bool):
+    """Set or clear a like edge and adjust a random counter shard
+
+    Returns (changed, first), where first is True if the user had never liked
+    the post before.
+    """
+    post_doc = firestore_db.collection("posts").document(post_id).get(field_paths=["user_id"], transaction=transaction)
+    if not post_doc.exists:
+        raise HTTPException(status_code=404, detail="Post not found")
+
+    edge_ref = like_ref(post_id, user_id)
+    edge_doc = edge_ref.get(transaction=transaction)
+    # Edges written before unlikes kept them have no liked field
+    if (edge_doc.exists and edge_doc.to_dict().get("liked", True)) == liked:
+        return False, False
+
+    if liked:
+        transaction.set(edge_ref, {"user_id": user_id, "liked": True, "date": datetime.utcnow().isoformat()})
+    else:
+        transaction.update(edge_ref, {"liked": False})
+    shard_ref = like_shard_ref(post_id, random.randrange(LIKE_SHARD_COUNT))
+    transaction.set(shard_ref, {"count": firestore.Increment(1 if liked else -1)}, merge=True)
+    return True, liked and not edge_doc.exists
+
+def set_like(post_id: str, user_id: str, liked: bool):
+    """Like or unlike a post and queue its count for the next roll-up"""
+    changed, first = set_like_in_transaction(firestore_db.transaction(), post_id, user_id, liked)
+    if changed:
+        with _dirty_like_posts_lock:
+            _dirty_like_posts.add(post_id)
+    # Liking a post again after unliking it is not new engagement
+    if first:
+        record_engagement(post_id, "like")
+    return changed
+
+def materialize_like_count(post_id: str):
+    """Sum a post's counter shards and store the total on the post"""
+    shard_docs = firestore_db.collection("posts").document(post_id).collection("like_shards").stream()
+    total = sum((shard_doc.to_dict() or {}).get("count", 0) for shard_doc in shard_docs)
+    firestore_db.collection("posts").document(post_id).update({"likes": total})
+    return total
+
+async def flush_like_counts():
+    """Write the current like totals of every post liked since the last flush"""
+    with _dirty_like_posts_lock:
+        post_ids = list(_dirty_like_posts)
+        _dirty_like_posts.clear()
+
+    for post_id in post_ids:
         try:
-            post_user_ref = firestore_db.collection("users").document(post["user_id"])
-            post_user_data = post_user_ref.get().to_dict()
-            
-            if post_user_data:
-                post["user_name"] = post_user_data.get("name", "")
-                post["user_profile_picture"] = post_user_data.get("profile_picture", "")
-        except Exception as e:
-            print(f"Error fetching user data for post: {e}")
+            await run_db(materialize_like_count, post_id)
+            invalidate_cached(f"post:{post_id}")
+        except Exception:
+            logger.exception("Error updating like count", extra={"fields": {"post_id": post_id}})
+
+async def like_count_flusher():
+    """Background task that rolls up like counts every LIKE_FLUSH_INTERVAL seconds"""
+    while True:
+        await asyncio.sleep(LIKE_FLUSH_INTERVAL)
+        await flush_like_counts()
+
+def mark_liked_posts(posts: List[dict], user_id: str):
+    """Set "liked" on each post the user has liked, using one batched read"""
+    liked_ids = set()
+    if posts:
+        like_refs = [like_ref(post["id"], user_id) for post in posts]
+        post_ids_by_path = {ref.path: post["id"] for ref, post in zip(like_refs, posts)}
+        for like_doc in firestore_db.get_all(like_refs, field_paths=["liked"]):
+            if like_doc.exists and like_doc.to_dict().get("liked", True):
+                liked_ids.add(post_ids_by_path[like_doc.reference.path])
+    for post in posts:
+        post["liked"] = post["id"] in liked_ids
+    return posts
+
+# ------------------------
+# Helper: Trending
+# ------------------------
+# Each new post, like and comment adds its weight times 2^(t / half life) to
+# the post's score. Every score decays at the same rate, so this ranks posts
+# exactly like decaying all scores would, and adding is the only update a
+# score ever needs. Scores are kept as log2 so they never overflow. Engagement
+# is summed in memory and every TRENDING_COMPACT_INTERVAL seconds a
+# transaction merges it into trending/posts, which keeps only the
+# TRENDING_CANDIDATES highest scores. Explore reads that one document and the
+# posts at its top, never the posts collection as a whole.
+_pending_trending = {}   # post_id -> log2 score added since the last compaction
+_pending_trending_lock = threading.Lock()
+
+def trending_ref():
+    """Return the document holding the stored ranking"""
+    return firestore_db.collection("trending").document("posts")
+
+def add_log2(a: float, b: float) -> float:
+    """log2(2^a + 2^b), without leaving log space"""
+    high, low = max(a, b), min(a, b)
+    return high + math.log2(1 + 2 ** (low - high))
+
+def record_engagement(post_id: str, kind: str):
+    """Add a new post, like or comment to the post's score at the next compaction"""
+    score = math.log2(TRENDING_WEIGHTS[kind]) + time.time() / TRENDING_HALF_LIFE
+    with _pending_trending_lock:
+        current = _pending_trending.get(post_id)
+        _pending_trending[post_id] = score if current is None else add_log2(current, score)
+
+@firestore.transactional
+def merge_trending_in_transaction(transaction, pending: dict):
+    """Add pending scores to the stored ranking and keep its top TRENDING_CANDIDATES"""
+    ranking_doc = trending_ref().get(transaction=transaction)
+    scores = {entry["post_id"]: entry["score"] for entry in (ranking_doc.to_dict() or {}).get("ranking", [])}
+    for post_id, score in pending.items():
+        scores[post_id] = add_log2(scores[post_id], score) if post_id in scores else score
+    top = heapq.nlargest(TRENDING_CANDIDATES, scores.items(), key=lambda item: item[1])
+    transaction.set(trending_ref(), {
+        "ranking": [{"post_id": post_id, "score": score} for post_id, score in top],
+        "updated_at": firestore.SERVER_TIMESTAMP
+    })
+
+async def compact_trending():
+    """Merge the engagement recorded since the last compaction into the stored ranking"""
+    with _pending_trending_lock:
+        pending = dict(_pending_trending)
+        _pending_trending.clear()
+    if not pending:
+        return
+
+    try:
+        await run_db(merge_trending_in_transaction, firestore_db.transaction(), pending)
+        invalidate_cached("trending")
+    except Exception:
+        logger.exception("Error updating trending posts", extra={"fields": {"posts": len(pending)}})
+        # Keep the scores for the next attempt
+        with _pending_trending_lock:
+            for post_id, score in pending.items():
+                current = _pending_trending.get(post_id)
+                _pending_trending[post_id] = score if current is None else add_log2(current, score)
+
+async def trending_compactor():
+    """Background task that compacts trending scores every TRENDING_COMPACT_INTERVAL seconds"""
+    while True:
+        await asyncio.sleep(TRENDING_COMPACT_INTERVAL)
+        await compact_trending()
+
+def get_trending_posts(limit: int = TRENDING_PAGE_SIZE, fields: Optional[List[str]] = None):
+    """Return the posts at the top of the stored ranking, highest score first
+
+    With fields, only those fields are read and the posts are returned as stored.
+    """
+    ranking = (trending_ref().get().to_dict() or {}).get("ranking", [])[:limit]
+    if not ranking:
+        return []
+    post_refs = [firestore_db.collection("posts").document(entry["post_id"]) for entry in ranking]
+    post_docs = {post_doc.id: post_doc for post_doc in firestore_db.get_all(post_refs, field_paths=fields) if post_doc.exists}
+    ranked_docs = [post_docs[entry["post_id"]] for entry in ranking if entry["post_id"] in post_docs]
+    if fields is not None:
+        return [{**post_doc.to_dict(), "id": post_doc.id} for post_doc in ranked_docs]
+    return [post_from_doc(post_doc) for post_doc in ranked_docs]
+
+# ------------------------
+# Helper: Follow lists
+# ------------------------
+# Every follow is an edge document follows/{follower}_{followee} carrying each
+# side's name sort key, and users keep follower_count and following_count.
+# "Does A follow B" is a single document lookup, and follower and following
+# lists are read a page at a time in name order straight from the edges, so a
+# user's whole follower list is never loaded. Those list queries need the
+# composite indexes in firestore.indexes.json (deploy them with
+# "firebase deploy --only firestore:indexes").
+FOLLOW_LIST_FIELDS = {
+    # list name: (field matching the profile user, field holding the listed user, sort key field)
+    "followers": ("followee_id", "follower_id", "follower_sort_name"),
+    "following": ("follower_id", "followee_id", "followee_sort_name"),
+}
+
+def name_sort_key(name: Optional[str]) -> str:
+    """Normalize a display name for case-insensitive ordering and prefix matching"""
+    return (name or "").strip().lower()
+
+def follow_edge_ref(follower_id: str, followee_id: str):
+    """Return the edge document recording that follower follows followee"""
+    return firestore_db.collection("follows").document(f"{follower_id}_{followee_id}")
+
+def follow_edge(follower_id: str, follower_name: str, followee_id: str, followee_name: str):
+    """Build the edge document stored for a follow"""
+    return {
+        "follower_id": follower_id,
+        "followee_id": followee_id,
+        "follower_sort_name": name_sort_key(follower_name),
+        "followee_sort_name": name_sort_key(followee_name),
+        "created_at": datetime.utcnow().isoformat()
+    }
+
+def is_following(follower_id: str, followee_id: str) -> bool:
+    """Whether follower follows followee"""
+    return follow_edge_ref(follower_id, followee_id).get(field_paths=["followee_id"]).exists
+
+def get_followed_ids(follower_id: str, candidate_ids) -> set:
+    """Return which of the candidate users the follower follows, in one batched read"""
+    edge_refs = [follow_edge_ref(follower_id, candidate_id) for candidate_id in dict.fromkeys(candidate_ids)]
+    if not edge_refs:
+        return set()
+    return {edge_doc.get("followee_id") for edge_doc in firestore_db.get_all(edge_refs, field_paths=["followee_id"]) if edge_doc.exists}
+
+def get_follower_ids(user_id: str) -> List[str]:
+    """Return the IDs of everyone following a user"""
+    edges_ref = firestore_db.collection("follows").where("followee_id", "==", user_id).select(["follower_id"])
+    return [edge_doc.get("follower_id") for edge_doc in edges_ref.stream()]
+
+def add_follow(follower_id: str, follower_name: str, followee_id: str, followee_name: str) -> bool:
+    """Record a follow, bump both users' counts and backfill the timeline in one atomic batch
+
+    The edge is created with a must-not-exist precondition, so following
+    someone twice fails the whole batch and leaves the counts alone. Returns
+    whether a new follow was recorded.
+    """
+    users_ref = firestore_db.collection("users")
+    batch = firestore_db.batch()
+    batch.create(follow_edge_ref(follower_id, followee_id), follow_edge(follower_id, follower_name, followee_id, followee_name))
+    batch.update(users_ref.document(follower_id), {"following_count": firestore.Increment(1)})
+    batch.update(users_ref.document(followee_id), {"follower_count": firestore.Increment(1)})
+    backfill_timeline(follower_id, followee_id, batch)
+    try:
+        batch.commit()
+    except AlreadyExists:
+        return False
+    return True
+
+def remove_follow(follower_id: str, followee_id: str) -> bool:
+    """Delete a follow, decrement both users' counts and prune the timeline in one atomic batch
+
+    Timelines holding more than FANOUT_BATCH_SIZE of the user's posts are
+    pruned in further batches. Returns whether there was a follow to remove.
+    """
+    users_ref = firestore_db.collection("users")
+    batch = firestore_db.batch()
+    batch.delete(follow_edge_ref(follower_id, followee_id), option=firestore_db.write_option(exists=True))
+    batch.update(users_ref.document(follower_id), {"following_count": firestore.Increment(-1)})
+    batch.update(users_ref.document(followee_id), {"follower_count": firestore.Increment(-1)})
+    try:
+        prune_timeline(follower_id, followee_id, batch)
+    except NotFound:
+        return False
+    return True
+
+def count_docs(query) -> int:
+    """Count the documents matching a query with an aggregation, without reading them"""
+    return int(query.count().get()[0][0].value)
+
+def needs_count_migration(user_data: dict) -> bool:
+    """Whether a user still lacks edge-based follow counts or a post count"""
+    return not user_data.get("follow_graph_migrated") or "post_count" not in user_data
+
+def migrate_follow_graph(user_id: str, user_data: Optional[dict] = None, extra_fields: Optional[dict] = None):
+    """Move a user from follower/following arrays to edge documents and counts
+
+    Follows made before edges existed only live in the arrays, so they are
+    copied across once (follow_edges_migrated), skipping users whose own edges
+    are already complete. The follow counts are then taken from the edges and
+    post_count from the user's posts, and the arrays are dropped
+    (follow_graph_migrated) in one update, together with any extra_fields.
+    Returns the user data as it is afterwards, or None if the user doesn't
+    exist.
+    """
+    user_ref = firestore_db.collection("users").document(user_id)
+    if user_data is None:
+        user_doc = user_ref.get()
+        if not user_doc.exists:
+            return None
+        user_data = user_doc.to_dict()
+    if not needs_count_migration(user_data):
+        return user_data
+
+    if not user_data.get("follow_edges_migrated"):
+        pairs = [(follower_id, user_id) for follower_id in user_data.get("followers", [])]
+        pairs += [(user_id, followee_id) for followee_id in user_data.get("following", [])]
+        others = get_users_by_ids(
+            [other_id for pair in pairs for other_id in pair if other_id != user_id], ["name", "follow_edges_migrated"]
+        )
+        others[user_id] = user_data
+
+        for start in range(0, len(pairs), FANOUT_BATCH_SIZE):
+            batch = firestore_db.batch()
+            for follower_id, followee_id in pairs[start:start + FANOUT_BATCH_SIZE]:
+                other_id = followee_id if follower_id == user_id else follower_id
+                if other_id not in others or others[other_id].get("follow_edges_migrated"):
+                    continue
+                edge = follow_edge(follower_id, others[follower_id].get("name"), followee_id, others[followee_id].get("name"))
+                batch.set(follow_edge_ref(follower_id, followee_id), edge)
+            batch.commit()
+
+    edges_ref = firestore_db.collection("follows")
+    migrated_fields = {
+        "follower_count": count_docs(edges_ref.where("followee_id", "==", user_id)),
+        "following_count": count_docs(edges_ref.where("follower_id", "==", user_id)),
+        "post_count": count_docs(firestore_db.collection("posts").where("user_id", "==", user_id)),
+        "follow_edges_migrated": True,
+        "follow_graph_migrated": True,
+        **(extra_fields or {})
+    }
+    user_ref.update({**migrated_fields, "followers": firestore.DELETE_FIELD, "following": firestore.DELETE_FIELD})
+
+    user_data = {key: value for key, value in user_data.items() if key not in ("followers", "following")}
+    return {**user_data, **migrated_fields}
+
+def refresh_follow_edge_names(user_id: str, name: str):
+    """Rewrite a user's name sort key on all of their follow edges after a rename"""
+    sort_name = name_sort_key(name)
+    for match_field, sort_field in (("follower_id", "follower_sort_name"), ("followee_id", "followee_sort_name")):
+        edges_ref = firestore_db.collection("follows").where(match_field, "==", user_id).select([sort_field])
+        batch = firestore_db.batch()
+        pending = 0
+        for edge_doc in edges_ref.stream():
+            if edge_doc.get(sort_field) == sort_name:
+                continue
+            batch.update(edge_doc.reference, {sort_field: sort_name})
+            pending += 1
+            if pending == FANOUT_BATCH_SIZE:
+                batch.commit()
+                batch = firestore_db.batch()
+                pending = 0
+        if pending:
+            batch.commit()
+
+async def refresh_follow_names(user_id: str):
+    """Background job: re-sort a renamed user in follow lists under their current name"""
+    user_doc = await run_db(firestore_db.collection("users").document(user_id).get, field_paths=["name"])
+    if not user_doc.exists:
+        return
+    await run_db(refresh_follow_edge_names, user_id, user_doc.to_dict().get("name"))
+    invalidate_cached(f"user:{user_id}")
+
+def get_follow_list_page(user_id: str, list_name: str, limit: int = FOLLOW_LIST_PAGE_SIZE, cursor: Optional[dict] = None):
+    """Return one page of a user's followers or following, ordered by name
+
+    Returns the listed users' summaries and the cursor for the next page.
+    """
+    match_field, listed_field, sort_field = FOLLOW_LIST_FIELDS[list_name]
+    edges_ref = (
+        firestore_db.collection("follows")
+        .where(match_field, "==", user_id)
+        .order_by(sort_field)
+        .order_by("__name__")
+    )
+    if cursor:
+        edges_ref = edges_ref.start_after(cursor)
+    edge_docs = list(edges_ref.limit(limit).stream())
+
+    listed_ids = [edge_doc.get(listed_field) for edge_doc in edge_docs]
+    summaries = get_user_summaries(listed_ids)
+    users = [{**summaries[listed_id], "id": listed_id} for listed_id in listed_ids if listed_id in summaries]
+
+    next_cursor = None
+    if len(edge_docs) == limit:
+        next_cursor = encode_cursor(edge_docs[-1].get(sort_field), edge_docs[-1].id)
+    return users, next_cursor
+
+# ------------------------
+# Helper: Search
+# ------------------------
+# Users carry lowercased copies of their name and username. A search is a
+# range query over each, [prefix, prefix + "\uf8ff"), so only matching users
+# are read rather than the whole users collection. Users from before the index
+# are indexed once by a startup task, whether or not they sign in again.
+def search_fields(name: Optional[str], username: Optional[str]):
+    """Return the normalized fields that index a user for prefix search"""
+    return {"name_lower": name_sort_key(name), "username_lower": name_sort_key(username)}
+
+def index_users_page(after=None):
+    """Index one page of users in document ID order that lack search fields
+
+    Returns the page's last snapshot to continue after, or None at the end.
+    """
+    users_ref = (
+        firestore_db.collection("users")
+        .order_by("__name__")   # Document ID order
+        .select(["name", "username", "name_lower"])
+        .limit(FANOUT_BATCH_SIZE)
+    )
+    if after is not None:
+        users_ref = users_ref.start_after(after)
+    user_docs = list(users_ref.stream())
+
+    batch = firestore_db.batch()
+    indexed_ids = []
+    for user_doc in user_docs:
+        user = user_doc.to_dict()
+        if "name_lower" not in user:
+            batch.update(user_doc.reference, search_fields(user.get("name"), user.get("username")))
+            indexed_ids.append(user_doc.id)
+    if indexed_ids:
+        batch.commit()
+        invalidate_cached(*(f"user:{user_id}" for user_id in indexed_ids))
+    return user_docs[-1] if len(user_docs) == FANOUT_BATCH_SIZE else None
+
+async def backfill_search_index():
+    """Background task: index all users from before prefix search, a page at a time, once
+
+    migrations/search_index is written when every page is done, so later
+    starts skip the scan; an interrupted scan starts over at the next start.
+    """
+    marker_ref = firestore_db.collection("migrations").document("search_index")
+    try:
+        if (await run_db(marker_ref.get)).exists:
+            return
+        after = await run_db(index_users_page)
+        while after is not None:
+            after = await run_db(index_users_page, after)
+        await run_db(marker_ref.set, {"completed_at": firestore.SERVER_TIMESTAMP})
+        logger.info("Search index backfill finished")
+    except Exception:
+        logger.exception("Error backfilling the search index")
+
+def search_users_by_field(field: str, prefix: str, limit: int = SEARCH_RESULT_LIMIT):
+    """Return summaries of users whose indexed field starts with prefix"""
+    users_ref = (
+        firestore_db.collection("users")
+        .where(field, ">=", prefix)
+        .where(field, "<", prefix + "\uf8ff")
+        .order_by(field)
+        .limit(limit)
+        .select(USER_SUMMARY_FIELDS + ["name_lower"])
+    )
+    version = user_cache.version()
+    users = [{**user_doc.to_dict(), "id": user_doc.id} for user_doc in users_ref.stream()]
+    cache_user_summaries(users, version)
+    return users
+
+async def search_users_by_prefix(query: Optional[str]) -> List[dict]:
+    """Return summaries of users whose name or username starts with the query, alphabetically"""
+    prefix = name_sort_key(query).lstrip("@")
+    if not prefix:
+        return []
+
+    # Query the name and username indexes for users starting with the prefix
+    name_matches, username_matches = await asyncio.gather(
+        run_db(search_users_by_field, "name_lower", prefix),
+        run_db(search_users_by_field, "username_lower", prefix)
+    )
+    matches = {user["id"]: user for user in name_matches + username_matches}
+
+    # Sort results alphabetically
+    return sorted(
+        matches.values(), key=lambda x: (x.get("name_lower") or name_sort_key(x.get("name")), x["id"])
+    )[:SEARCH_RESULT_LIMIT]
+
+# ------------------------
+# Helper: Timelines
+# ------------------------
+# Each user has a timelines/{user_id}/posts subcollection holding one small
+# entry per post that should appear in their home feed. create_post writes
+# the author's entry and a background job those of every follower
+# (fan-out-on-write). Authors with
+# more than FANOUT_FOLLOWER_THRESHOLD followers are flagged fanout_on_read and
+# their posts are instead pulled in when a follower's feed is read. Users who
+# posted or followed before timelines existed get theirs filled the first time
+# their feed is read.
+_high_fanout_cache = {"user_ids": set(), "expires_at": 0.0}
+_high_fanout_lock = threading.Lock()
+
+def timeline_ref(user_id: str):
+    """Return the timeline entries collection for a user"""
+    return firestore_db.collection("timelines").document(user_id).collection("posts")
+
+def timeline_entry(post_id: str, post_data: dict):
+    """Build the timeline entry stored for a post"""
+    return {"post_id": post_id, "user_id": post_data["user_id"], "date": post_data["date"]}
+
+def fan_out_post(post_id: str, post_data: dict, follower_ids: List[str]):
+    """Write a post into each follower's timeline in bounded batches"""
+    author_id = post_data["user_id"]
+    recipients = [follower_id for follower_id in follower_ids if follower_id != author_id]
+    entry = timeline_entry(post_id, post_data)
+
+    batch = firestore_db.batch()
+    for recipient_id in recipients:
+        if len(batch) >= FANOUT_BATCH_SIZE:
+            batch.commit()
+            batch = firestore_db.batch()
+        batch.set(timeline_ref(recipient_id).document(post_id), entry)
+    if len(batch):
+        batch.commit()
+
+async def fan_out_new_post(post_id: str, user_id: str, user_name: str, date: str):
+    """Background job: copy a new post into its author's followers' timelines and tell their open feeds"""
+    follower_ids = await run_db(get_follower_ids, user_id)
+    await run_db(fan_out_post, post_id, {"user_id": user_id, "date": date}, follower_ids)
+    feed_topics = [f"feed:{follower_id}" for follower_id in follower_ids]
+    invalidate_cached(*feed_topics)
+    event_broker.publish(feed_topics, "post", {"post_id": post_id, "user_id": user_id, "user_name": user_name})
+
+def get_high_fanout_user_ids():
+    """Return the IDs of authors whose posts are merged into feeds at read time"""
+    with _high_fanout_lock:
+        if _high_fanout_cache["expires_at"] > time.monotonic():
+            return _high_fanout_cache["user_ids"]
+
+        query = firestore_db.collection("users").where("fanout_on_read", "==", True).select(["fanout_on_read"])
+        user_ids = {user_doc.id for user_doc in query.stream()}
+        _high_fanout_cache["user_ids"] = user_ids
+        _high_fanout_cache["expires_at"] = time.monotonic() + HIGH_FANOUT_CACHE_TTL
+        return user_ids
+
+def copy_recent_posts(user_id: str, author_id: str, batch):
+    """Add writes copying an author's most recent posts into a user's timeline to batch"""
+    posts_ref = (
+        firestore_db.collection("posts")
+        .where("user_id", "==", author_id)
+        .order_by("date", direction=firestore.Query.DESCENDING)
+        .limit(TIMELINE_BACKFILL_SIZE)
+        .select(["user_id", "date"])
+    )
+    for post_doc in posts_ref.stream():
+        batch.set(timeline_ref(user_id).document(post_doc.id), timeline_entry(post_doc.id, post_doc.to_dict()))
+
+def backfill_timeline(follower_id: str, followee_id: str, batch):
+    """Add writes copying a followed user's most recent posts into the follower's timeline to batch"""
+    if followee_id in get_high_fanout_user_ids():
+        return
+    copy_recent_posts(follower_id, followee_id, batch)
+
+def backfill_existing_timeline(user_id: str):
+    """Fill the timeline of a user whose posts and follows predate timelines
+
+    Copies the user's own recent posts and those of everyone they follow, the
+    same way a new follow does, then marks the user timeline_backfilled.
+    Follows must already be edges (see migrate_follow_graph).
+    """
+    batch = firestore_db.batch()
+    copy_recent_posts(user_id, user_id, batch)
+    edges_ref = firestore_db.collection("follows").where("follower_id", "==", user_id).select(["followee_id"])
+    for edge_doc in edges_ref.stream():
+        if len(batch) + TIMELINE_BACKFILL_SIZE > FANOUT_BATCH_SIZE:
+            batch.commit()
+            batch = firestore_db.batch()
+        backfill_timeline(user_id, edge_doc.to_dict()["followee_id"], batch)
+    batch.update(firestore_db.collection("users").document(user_id), {"timeline_backfilled": True})
+    batch.commit()
+    invalidate_cached(f"user:{user_id}")
+
+async def fill_existing_timeline(user_id: str):
+    """Background job: fill the timeline of a user from before timelines"""
+    user_doc = await run_db(firestore_db.collection("users").document(user_id).get, field_paths=["timeline_backfilled"])
+    if (user_doc.to_dict() or {}).get("timeline_backfilled"):
+        return
+    await run_db(backfill_existing_timeline, user_id)
+    invalidate_cached(f"feed:{user_id}")
+
+async def request_timeline_backfill(user_data: dict):
+    """Queue the timeline fill for a user from before timelines; their feed stays short until it runs"""
+    if not user_data.get("timeline_backfilled"):
+        await job_queue.enqueue("backfill-timeline", f"backfill-timeline:{user_data['id']}", user_id=user_data["id"])
+
+def prune_timeline(follower_id: str, followee_id: str, batch=None):
+    """Remove an unfollowed user's posts from the follower's timeline
+
+    The first page of deletions goes into the given batch and commits with the
+    writes already in it; later pages are only removed once that succeeded.
+    """
+    entries_ref = timeline_ref(follower_id).where("user_id", "==", followee_id).limit(FANOUT_BATCH_SIZE)
+    while True:
+        entry_docs = list(entries_ref.stream())
+        batch = batch or firestore_db.batch()
+        for entry_doc in entry_docs:
+            batch.delete(entry_doc.reference)
+        if len(batch):
+            batch.commit()
+        if len(entry_docs) < FANOUT_BATCH_SIZE:
+            return
+        batch = None
+
+def get_timeline_posts(user_data: dict, limit: int = FEED_PAGE_SIZE, cursor: Optional[dict] = None, fields: Optional[List[str]] = None):
+    """Return one page of a user's home feed, newest first
+
+    Pushed timeline entries are merged with posts pulled from any followed
+    fan-out-on-read authors. Every source is read from the same cursor, so
+    merging them keeps pages consistent. With fields (which must include
+    "date"), only those fields are read and the posts are returned as stored.
+    """
+    if fields is None:
+        to_post = post_from_doc
+    else:
+        def to_post(post_doc):
+            return {**post_doc.to_dict(), "id": post_doc.id}
+
+    entries_ref = paginate_by_date(timeline_ref(user_data["id"]), limit, cursor).select(["__name__"])
+    post_refs = [firestore_db.collection("posts").document(entry.id) for entry in entries_ref.stream()]
+    posts = {}
+    for post_doc in firestore_db.get_all(post_refs, field_paths=fields):
+        if post_doc.exists:
+            posts[post_doc.id] = to_post(post_doc)
+
+    high_fanout_ids = get_high_fanout_user_ids()
+    pulled_ids = sorted(get_followed_ids(user_data["id"], high_fanout_ids))
+    for start in range(0, len(pulled_ids), FIRESTORE_IN_QUERY_LIMIT):
+        pulled_ref = paginate_by_date(
+            firestore_db.collection("posts").where("user_id", "in", pulled_ids[start:start + FIRESTORE_IN_QUERY_LIMIT]),
+            limit,
+            cursor
+        )
+        if fields is not None:
+            pulled_ref = pulled_ref.select(fields)
+        for post_doc in pulled_ref.stream():
+            posts.setdefault(post_doc.id, to_post(post_doc))
+
+    return sorted(posts.values(), key=lambda post: (post.get("date", ""), post["id"]), reverse=True)[:limit]
+
+async def hydrate_feed_posts(posts: List[dict], viewer_id: str):
+    """Attach author names, avatars, the viewer's likes and display dates to feed posts"""
+    # Fetch user information for all post authors and the viewer's likes in batched reads
+    try:
+        post_users, _ = await asyncio.gather(
+            run_db(get_user_summaries, [post.get("user_id") for post in posts]),
+            run_db(mark_liked_posts, posts, viewer_id)
+        )
+    except Exception:
+        logger.exception("Error fetching user data for posts")
+        post_users = {}
+    
+    for post in posts:
+        post_user_data = post_users.get(post.get("user_id"))
+        if post_user_data:
+            post["user_name"] = post_user_data.get("name", "")
+            post["user_profile_picture"] = post_user_data.get("profile_picture", "")
         
         # Format the date
         try:
-            from datetime import datetime
             date_obj = datetime.fromisoformat(post["date"])
-            from dateutil.relativedelta import relativedelta
             now = datetime.utcnow()
             diff = relativedelta(now, date_obj)
             
@@ -214,25 +2271,144 @@ async def serve_home(request: Request, user_data = Depends(get_current_user)):
             else:
                 post["formatted_date"] = "Just now"
         except Exception as e:
-            print(f"Error formatting date: {e}")
+            logger.warning("Error formatting date", extra={"fields": {"post_id": post.get("id"), "error": str(e)}})
             # Keep the original date format as fallback
-        
-        posts.append(post)
     
-    return templates.TemplateResponse(
-        "home.html", 
-        {"request": request, "user_id": user_id, "user_data": user_data, "posts": posts}
-    )
+    return posts
+
+# ------------------------
+# Helper: Background jobs
+# ------------------------
+job_queue.register("fan-out-post", fan_out_new_post)
+job_queue.register("post-image", process_post_image)
+job_queue.register("profile-picture", process_profile_picture)
+job_queue.register("follow-names", refresh_follow_names)
+job_queue.register("backfill-timeline", fill_existing_timeline)
+
+# -------------------
+# FastAPI Routes
+# -------------------
+
+@app.on_event("startup")
+async def start_background_tasks():
+    """Load static pages and start the image and job workers, the periodic tasks, the search index backfill and, if enabled, the user change listener"""
+    global image_executor
+    await run_in_threadpool(load_static_pages)
+    # Spawned rather than forked so workers don't inherit the gRPC channels of the Firestore client.
+    # Created here rather than at import, so merely importing this module never starts a pool.
+    image_executor = ProcessPoolExecutor(max_workers=IMAGE_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+    await job_queue.start()
+    app.state.like_count_task = asyncio.create_task(like_count_flusher())
+    app.state.trending_task = asyncio.create_task(trending_compactor())
+    app.state.search_backfill_task = asyncio.create_task(backfill_search_index())
+    app.state.user_watch = await run_db(watch_user_changes) if USER_CACHE_LISTENER else None
+
+@app.on_event("shutdown")
+async def stop_background_tasks():
+    """Stop the periodic tasks and listener, write pending like counts and trending scores and stop the job and image workers"""
+    app.state.like_count_task.cancel()
+    app.state.trending_task.cancel()
+    app.state.search_backfill_task.cancel()
+    if app.state.user_watch:
+        app.state.user_watch.unsubscribe()
+    await flush_like_counts()
+    await compact_trending()
+    await job_queue.stop()
+    if image_executor:
+        image_executor.shutdown(wait=False, cancel_futures=True)
+
+@app.get("/")
+async def serve_home(request: Request, user_data = Depends(get_current_user)):
+    """Home page route - if not authenticated, redirect to login"""
+    # If user is not authenticated, redirect to login page
+    if not user_data:
+        return RedirectResponse(url="/login", status_code=302)
+    
+    user_id = user_data["id"]
+    await request_timeline_backfill(user_data)
+
+    async def build():
+        # Fetch feed posts from the user's timeline and any followed fan-out-on-read authors
+        posts = await run_db(get_timeline_posts, user_data, FEED_PAGE_SIZE)
+        posts = await hydrate_feed_posts(posts, user_id)
+        high_fanout_ids = await run_db(get_high_fanout_user_ids)
+
+        html = render_page(
+            "home.html",
+            {
+                "request": request,
+                "user_id": user_id,
+                "user_data": user_data,
+                "posts": posts,
+                "next_cursor": next_cursor_for(posts, FEED_PAGE_SIZE)
+            }
+        )
+        tags = [f"viewer:{user_id}", f"feed:{user_id}"] + post_tags(posts) + [f"posts:{author_id}" for author_id in high_fanout_ids]
+        return html, tags
+
+    return HTMLResponse(await get_or_build(("home", user_id), build))
+
+@app.get("/feed")
+async def load_feed_page(
+    request: Request,
+    cursor: Optional[str] = Query(None),
+    format: str = Query("json"),
+    user_data = Depends(get_required_user)
+):
+    """Next page of the home feed as JSON, or as an HTML fragment with format=html"""
+    await request_timeline_backfill(user_data)
+    posts = await run_db(get_timeline_posts, user_data, FEED_PAGE_SIZE, decode_cursor(cursor))
+    posts = await hydrate_feed_posts(posts, user_data["id"])
+    next_cursor = next_cursor_for(posts, FEED_PAGE_SIZE)
+
+    if format == "html":
+        return templates.TemplateResponse(
+            "_feed_posts.html",
+            {"request": request, "posts": posts},
+            headers={"X-Next-Cursor": next_cursor or ""}
+        )
+    return JSONResponse(content=jsonable_encoder({"posts": posts, "next_cursor": next_cursor}))
+
+@app.get("/explore")
+async def serve_explore(request: Request, user_data = Depends(get_current_user)):
+    """Explore page: the posts with the most recent engagement from everyone"""
+    if not user_data:
+        return RedirectResponse(url="/login", status_code=302)
+
+    user_id = user_data["id"]
+
+    async def build_ranking():
+        posts = await run_db(get_trending_posts, TRENDING_PAGE_SIZE)
+        return posts, ["trending"] + post_tags(posts)
+
+    async def build():
+        # The ranked posts are shared by all viewers; only likes and the page are built per viewer
+        posts = [dict(post) for post in await get_or_build(("trending",), build_ranking)]
+        posts = await hydrate_feed_posts(posts, user_id)
+        html = render_page(
+            "home.html",
+            {
+                "request": request,
+                "user_id": user_id,
+                "user_data": user_data,
+                "posts": posts,
+                "next_cursor": None,
+                "explore": True
+            }
+        )
+        return html, ["trending", f"viewer:{user_id}"] + post_tags(posts)
+
+    return HTMLResponse(await get_or_build(("explore", user_id), build))
 
 @app.get("/login")
 async def serve_login():
     """Login page - no authentication required"""
-    return HTMLResponse(open("templates/login.html").read())
+    return HTMLResponse(static_pages["login"])
 
 @app.get("/signup")
 async def serve_signup():
     """Signup page - no authentication required"""
-    return HTMLResponse(open("templates/signup.html").read())
+    return HTMLResponse(static_pages["signup"])
 
 @app.get("/profile/{user_id}")
 async def serve_profile(request: Request, user_id: str, current_user = Depends(get_current_user)):
@@ -241,32 +2417,82 @@ async def serve_profile(request: Request, user_id: str, current_user = Depends(g
     if not current_user:
         return RedirectResponse(url="/login", status_code=302)
     
-    # Fetch user data (e.g., posts, followers) from Firestore based on user_id
-    user_ref = firestore_db.collection("users").document(user_id)
-    user_data = user_ref.get().to_dict()
-    if not user_data:
-        raise HTTPException(status_code=404, detail="User not found")
+    viewer_id = current_user["id"]
 
-    # Add the user ID to the user data
-    user_data["id"] = user_id
+    async def build_profile_data():
+        # Fetch the user's profile (including follow counts) and their posts from Firestore concurrently
+        user_ref = firestore_db.collection("users").document(user_id)
+        user_doc, posts = await asyncio.gather(run_db(user_ref.get), run_db(get_profile_posts, user_id, PROFILE_PAGE_SIZE))
+
+        user_data = user_doc.to_dict()
+        if not user_data:
+            raise HTTPException(status_code=404, detail="User not found")
+
+        # Replace a not yet migrated user's follower arrays with counts and count their posts
+        if needs_count_migration(user_data):
+            user_data = await run_db(migrate_follow_graph, user_id, user_data)
+
+        # Add the user ID to the user data
+        user_data["id"] = user_id
+        return (user_data, posts), [f"user:{user_id}"] + post_tags(posts)
+
+    async def build_viewer_state():
+        liked_posts = [dict(post) for post in posts]
+        _, following = await asyncio.gather(
+            run_db(mark_liked_posts, liked_posts, viewer_id),
+            run_db(is_following, viewer_id, user_id)
+        )
+        liked_ids = frozenset(post["id"] for post in liked_posts if post.get("liked"))
+        return (liked_ids, following), [f"user:{user_id}", f"viewer:{viewer_id}"]
 
-    # Retrieve posts for the user
-    posts_ref = firestore_db.collection("posts").where("user_id", "==", user_id).order_by("date", direction=firestore.Query.DESCENDING)
-    posts = [post.to_dict() for post in posts_ref.stream()]
+    # Profile data is shared by every viewer; only the likes and follow button depend on the viewer
+    user_data, posts = await get_or_build(("profile-data", user_id), build_profile_data)
+    liked_ids, following = await get_or_build(("profile-viewer", user_id, viewer_id), build_viewer_state)
 
     # Check if this is the current user's profile
-    is_own_profile = current_user["id"] == user_id
+    is_own_profile = viewer_id == user_id
 
-    return templates.TemplateResponse(
-        "profile.html", 
-        {
-            "request": request, 
-            "user_data": user_data, 
-            "posts": posts,
-            "is_own_profile": is_own_profile,
-            "current_user": current_user
-        }
-    )
+    async def build_page():
+        html = render_page(
+            "profile.html",
+            {
+                "request": request,
+                "user_data": user_data,
+                "posts": [{**post, "liked": post["id"] in liked_ids} for post in posts],
+                "next_cursor": next_cursor_for(posts, PROFILE_PAGE_SIZE),
+                "is_own_profile": is_own_profile,
+                "is_following": following,
+                "current_user": current_user
+            }
+        )
+        return html, [f"user:{user_id}"] + post_tags(posts)
+
+    page_key = ("profile", user_id, is_own_profile, following, liked_ids)
+    return HTMLResponse(await get_or_build(page_key, build_page))
+
+@app.get("/profile/{user_id}/posts")
+async def load_profile_posts_page(
+    request: Request,
+    user_id: str,
+    cursor: Optional[str] = Query(None),
+    format: str = Query("json"),
+    current_user = Depends(get_required_user)
+):
+    """Next page of a user's posts as JSON, or as an HTML fragment with format=html"""
+    posts = await run_db(get_profile_posts, user_id, PROFILE_PAGE_SIZE, decode_cursor(cursor))
+    await run_db(mark_liked_posts, posts, current_user["id"])
+    next_cursor = next_cursor_for(posts, PROFILE_PAGE_SIZE)
+
+    if format == "html":
+        users = await run_db(get_user_summaries, [user_id])
+        if user_id not in users:
+            raise HTTPException(status_code=404, detail="User not found")
+        return templates.TemplateResponse(
+            "_profile_posts.html",
+            {"request": request, "posts": posts, "user_data": {**users[user_id], "id": user_id}},
+            headers={"X-Next-Cursor": next_cursor or ""}
+        )
+    return JSONResponse(content=jsonable_encoder({"posts": posts, "next_cursor": next_cursor}))
 
 @app.get("/edit-profile")
 async def edit_profile(request: Request, current_user = Depends(get_current_user)):
@@ -305,29 +2531,39 @@ async def update_profile(
         "phone": phone,
         "gender": gender,
         "private_account": private_account,
-        "updated_at": datetime.utcnow().isoformat()
+        **search_fields(name, username),
+        "updated_at": firestore.SERVER_TIMESTAMP
     }
     
     # Handle profile picture upload
     form = await request.form()
     profile_picture = form.get("profile_picture")
     
+    renamed = name_sort_key(name) != name_sort_key(current_user.get("name"))
+    if (renamed or (profile_picture and profile_picture.filename)) and job_queue.full():
+        return overloaded_response("job_queue")
+
     if profile_picture and profile_picture.filename:
-        # Make sure the uploads directory exists
-        os.makedirs("static/uploads/profiles", exist_ok=True)
+        # Stream the image into the blob store
+        blob_name = await save_upload(profile_picture)
         
-        # Save the image to disk
-        image_filename = f"{user_id}_{datetime.utcnow().timestamp()}_{profile_picture.filename}"
-        image_path = f"static/uploads/profiles/{image_filename}"
-        
-        with open(image_path, "wb") as f:
-            f.write(await profile_picture.read())
-        
-        # Add profile picture path to update data
-        update_data["profile_picture"] = f"/{image_path}"
+        # Add profile picture URL to update data
+        update_data["profile_picture"] = blob_url(blob_name)
     
     # Update user profile in Firestore
-    user_ref.update(update_data)
+    await run_db(user_ref.update, update_data)
+    invalidate_cached(f"user:{user_id}")
+
+    # Re-sort the user in follow lists after responding. The job reads the current
+    # name, so a rerun or a later rename's job leaves the edges right either way.
+    if renamed:
+        await job_queue.enqueue("follow-names", f"follow-names:{user_id}:{uuid.uuid4().hex}", user_id=user_id)
+
+    # Resize the new profile picture after responding. The key is unique per update,
+    # since going back to an earlier picture needs its own switch to the thumbnail.
+    if "profile_picture" in update_data:
+        update_key = f"profile-picture:{user_id}:{uuid.uuid4().hex}"
+        await job_queue.enqueue("profile-picture", update_key, user_id=user_id, blob_name=blob_name)
     
     # Redirect to profile page
     return RedirectResponse(url=f"/profile/{user_id}", status_code=302)
@@ -344,58 +2580,112 @@ async def show_create_post_page(request: Request, user_data = Depends(get_requir
 async def create_post(
     request: Request,
     caption: str = Form(...),
+    format: Optional[str] = Query(None),
     user_data = Depends(get_required_user)
 ):
-    """Create a new post - requires authentication"""
+    """Create a new post - requires authentication
+
+    Forms are redirected to the author's profile; format=json returns the post instead.
+    """
     user_id = user_data["id"]
+    enforce_rate_limit("create-post", user_id)
+    if job_queue.full():
+        return overloaded_response("job_queue")
     
     # Process the form data
     form = await request.form()
     image = form.get("image")
     
-    if not image:
+    if not isinstance(image, UploadFile) or not image.filename:
         raise HTTPException(status_code=400, detail="Image file is required")
 
-    # Make sure the uploads directory exists
-    os.makedirs("static/uploads", exist_ok=True)
-    
-    # Save the image to disk
-    image_filename = f"{user_id}_{datetime.utcnow().timestamp()}_{image.filename}"
-    image_path = f"static/uploads/{image_filename}"
-    
-    with open(image_path, "wb") as f:
-        f.write(await image.read())
+    # Stream the image into the blob store
+    blob_name = await save_upload(image)
 
-    # Create the post in Firestore
+    # Pre-allocate the post ID so the post is written complete in a single set
+    post_ref = firestore_db.collection("posts").document()
+    post_id = post_ref.id
     post_data = {
+        "id": post_id,
         "user_id": user_id,
         "user_name": user_data.get("name", ""),  # Add username to post data
         "caption": caption,
-        "image_url": f"/{image_path}",  # Use relative path for frontend
+        "image_url": blob_url(blob_name),  # Use relative path for frontend
         "date": datetime.utcnow().isoformat(),
+        "created_at": firestore.SERVER_TIMESTAMP,
         "likes": 0,
-        "comments": []
+        "comment_count": 0,
+        "latest_comments": []
     }
-
-
-    
     
     # Add profile picture if available
     if "profile_picture" in user_data:
         post_data["user_profile_picture"] = user_data["profile_picture"]
 
-    # Add the post to Firestore
-    post_ref = firestore_db.collection("posts").document()
-    post_ref.set(post_data)
-    
-    # Get the post ID and add it to the post data
-    post_id = post_ref.id
-    post_ref.update({"id": post_id})
+    # Authors with too many followers have their posts merged into feeds at read time
+    author_update = {"post_count": firestore.Increment(1)}
+    fanout_on_read = user_data.get("follower_count", 0) > FANOUT_FOLLOWER_THRESHOLD
+    if fanout_on_read and not user_data.get("fanout_on_read"):
+        author_update["fanout_on_read"] = True
+
+    # The post, the author's post count and the author's timeline entry commit together
+    batch = firestore_db.batch()
+    batch.set(post_ref, post_data)
+    batch.update(firestore_db.collection("users").document(user_id), author_update)
+    batch.set(timeline_ref(user_id).document(post_id), timeline_entry(post_id, post_data))
+    await run_db(batch.commit)
+    invalidate_cached(f"user:{user_id}", f"posts:{user_id}", f"feed:{user_id}")
+    record_engagement(post_id, "post")
 
+    # Followers' timelines and the image variants are filled in after responding
+    if not fanout_on_read:
+        await job_queue.enqueue(
+            "fan-out-post", f"fan-out-post:{post_id}",
+            post_id=post_id, user_id=user_id, user_name=post_data["user_name"], date=post_data["date"]
+        )
+    await job_queue.enqueue("post-image", f"post-image:{post_id}", post_id=post_id, blob_name=blob_name)
+
+    # Let open feeds know there is something new; followers hear once fan-out is done
+    feed_topics = [f"feed:{user_id}"]
+    if fanout_on_read or user_data.get("fanout_on_read"):
+        feed_topics.append(f"author:{user_id}")
+    event_broker.publish(feed_topics, "post", {"post_id": post_id, "user_id": user_id, "user_name": post_data["user_name"]})
+
+    if format == "json":
+        post = {key: value for key, value in post_data.items() if key != "created_at"}
+        return JSONResponse(content={"success": True, "post": post, "profile_url": f"/profile/{user_id}"})
     return RedirectResponse(url=f"/profile/{user_id}", status_code=302)
 
 
 
+@app.get("/media/{blob_name}")
+async def get_media(request: Request, blob_name: str):
+    """Serve a stored blob; its name is its content hash, so it never changes
+
+    Blobs the backend can't serve locally are redirected to its download URL,
+    so their bytes never pass through the app.
+    """
+    if not BLOB_NAME_PATTERN.match(blob_name):
+        raise HTTPException(status_code=404, detail="Not found")
+
+    etag = f'"{os.path.splitext(blob_name)[0]}"'
+    headers = {"ETag": etag, "Cache-Control": MEDIA_CACHE_CONTROL}
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers=headers)
+
+    path = await run_in_threadpool(blob_storage.local_path, blob_name)
+    if path:
+        return FileResponse(path, headers=headers)
+
+    download_url = await run_in_threadpool(blob_storage.download_url, blob_name)
+    if not download_url:
+        raise HTTPException(status_code=404, detail="Not found")
+    # Let the browser reuse the redirect while the signed URL is still valid
+    return RedirectResponse(
+        url=download_url, status_code=307,
+        headers={"Cache-Control": f"private, max-age={SIGNED_URL_TTL // 2}"}
+    )
+
 @app.post("/auth/init")
 async def init_session(request: Request):
     """Initialize user session after login"""
@@ -421,7 +2711,7 @@ async def init_session(request: Request):
             )
 
         # 3. Verify token using your helper
-        user_data = get_user_from_token(token_str)
+        user_data = await run_db(get_user_from_token, token_str)
         if not user_data:
             return JSONResponse(
                 status_code=401,
@@ -429,8 +2719,10 @@ async def init_session(request: Request):
             )
 
         # 4. Set HTTP-only cookie (optional)
+        # Only what the client needs, not the whole user document
+        user = {key: user_data.get(key) for key in ("name", "username", "profile_picture")}
         response = JSONResponse(
-            content={"success": True, "message": "Session initialized", "user": user_data}
+            content={"success": True, "message": "Session initialized", "user": {"id": user_data["id"], **user}}
         )
         response.set_cookie(
         key="token",
@@ -446,57 +2738,12 @@ async def init_session(request: Request):
         return response
 
     except Exception as e:
-        print(f"Session init error: {e}")
+        logger.exception("Session init error")
         return JSONResponse(
             status_code=500,
             content={"success": False, "error": "Server error: " + str(e)}
         )
-    
-@app.post("/create-post")
-async def create_post(
-    request: Request,
-    caption: str = Form(...),
-    user_data = Depends(get_required_user)
-):
-    """Create a new post - requires authentication"""
-    user_id = user_data["id"]
-    
-    # Process the form data
-    form = await request.form()
-    image = form.get("image")
-    
-    if not image:
-        raise HTTPException(status_code=400, detail="Image file is required")
-
-    # Make sure the uploads directory exists
-    os.makedirs("static/uploads", exist_ok=True)
-    
-    # Save the image to disk
-    image_filename = f"{user_id}_{datetime.utcnow().timestamp()}_{image.filename}"
-    image_path = f"static/uploads/{image_filename}"
-    
-    with open(image_path, "wb") as f:
-        f.write(await image.read())
-
-    # Create the post in Firestore
-    post_data = {
-        "user_id": user_id,
-        "caption": caption,
-        "image_url": f"/{image_path}",  # Use relative path for frontend
-        "date": datetime.utcnow().isoformat(),
-        "likes": 0,
-        "comments": []
-    }
-
-    # Add the post to Firestore
-    post_ref = firestore_db.collection("posts").document()
-    post_ref.set(post_data)
-    
-    # Get the post ID and add it to the post data
-    post_id = post_ref.id
-    post_ref.update({"id": post_id})
 
-    return RedirectResponse(url=f"/profile/{user_id}", status_code=302)
 
 @app.post("/follow/{user_id}")
 async def follow_user(
@@ -508,39 +2755,20 @@ async def follow_user(
     """Follow a user - requires authentication"""
     if user_id == current_user["id"]:
         raise HTTPException(status_code=400, detail="Cannot follow yourself")
+    enforce_rate_limit("follow", current_user["id"])
     
     # Check if user to follow exists
-    user_to_follow_ref = firestore_db.collection("users").document(user_id)
-    user_to_follow_doc = user_to_follow_ref.get()
-    
-    if not user_to_follow_doc.exists:
+    followee = (await run_db(get_user_summaries, [user_id])).get(user_id)
+    if not followee:
         raise HTTPException(status_code=404, detail=f"User with ID {user_id} not found")
-    
-    user_to_follow = user_to_follow_doc.to_dict()
-    
-    # Update current user's following list
-    current_user_ref = firestore_db.collection("users").document(current_user["id"])
-    
-    # Initialize arrays if they don't exist
-    if "following" not in current_user:
-        current_user_ref.update({"following": []})
-        current_user["following"] = []
-    
-    if user_id not in current_user["following"]:
-        current_user_ref.update({
-            "following": firestore.ArrayUnion([user_id])
-        })
-    
-    # Initialize followers array if it doesn't exist
-    if "followers" not in user_to_follow:
-        user_to_follow_ref.update({"followers": []})
-        user_to_follow["followers"] = []
-    
-    # Update followed user's followers list
-    if current_user["id"] not in user_to_follow.get("followers", []):
-        user_to_follow_ref.update({
-            "followers": firestore.ArrayUnion([current_user["id"]])
-        })
+
+    # Record the follow edge and both counts, and bring the followed user's recent posts into the feed
+    followed = await run_db(add_follow, current_user["id"], current_user.get("name"), user_id, followee.get("name"))
+    invalidate_cached(f"user:{user_id}", f"user:{current_user['id']}", f"viewer:{current_user['id']}", f"feed:{current_user['id']}")
+    if followed:
+        event_broker.publish(
+            [f"user:{user_id}"], "follow", {"follower_id": current_user["id"], "follower_name": current_user.get("name", "")}
+        )
     
     # Check if a custom redirect URL was provided (for staying on search page)
     if redirect_url:
@@ -559,30 +2787,11 @@ async def unfollow_user(
     """Unfollow a user - requires authentication"""
     if user_id == current_user["id"]:
         raise HTTPException(status_code=400, detail="Cannot unfollow yourself")
+    enforce_rate_limit("follow", current_user["id"])
     
-    # Check if user to unfollow exists
-    user_to_unfollow_ref = firestore_db.collection("users").document(user_id)
-    user_to_unfollow_doc = user_to_unfollow_ref.get()
-    
-    if not user_to_unfollow_doc.exists:
-        raise HTTPException(status_code=404, detail=f"User with ID {user_id} not found")
-    
-    user_to_unfollow = user_to_unfollow_doc.to_dict()
-    
-    # Update current user's following list
-    current_user_ref = firestore_db.collection("users").document(current_user["id"])
-    
-    # Only try to remove if the "following" array exists and contains the target user
-    if "following" in current_user and user_id in current_user["following"]:
-        current_user_ref.update({
-            "following": firestore.ArrayRemove([user_id])
-        })
-    
-    # Only try to remove if the "followers" array exists and contains the current user
-    if "followers" in user_to_unfollow and current_user["id"] in user_to_unfollow["followers"]:
-        user_to_unfollow_ref.update({
-            "followers": firestore.ArrayRemove([current_user["id"]])
-        })
+    # Remove the follow edge and both counts, and drop the unfollowed user's posts from the feed
+    await run_db(remove_follow, current_user["id"], user_id)
+    invalidate_cached(f"user:{user_id}", f"user:{current_user['id']}", f"viewer:{current_user['id']}", f"feed:{current_user['id']}")
     
     # Check if a custom redirect URL was provided (for staying on search page)
     if redirect_url:
@@ -591,80 +2800,80 @@ async def unfollow_user(
     # Otherwise, redirect back to the profile page
     return RedirectResponse(url=f"/profile/{user_id}", status_code=302)
 
+async def render_follow_list(request: Request, user_id: str, list_name: str, cursor: Optional[str], format: str, current_user: dict):
+    """Render one page of a user's followers or following"""
+    _, _, sort_field = FOLLOW_LIST_FIELDS[list_name]
+    page_cursor = decode_cursor(cursor, sort_field)
+
+    async def build_list():
+        profile_users = await run_db(get_users_by_ids, [user_id], USER_SUMMARY_FIELDS + ["follow_graph_migrated"])
+        if user_id not in profile_users:
+            raise HTTPException(status_code=404, detail=f"User with ID {user_id} not found")
+        profile_user = {**profile_users[user_id], "id": user_id}
+
+        if needs_count_migration(profile_user):
+            await run_db(migrate_follow_graph, user_id)
+
+        users, next_cursor = await run_db(get_follow_list_page, user_id, list_name, FOLLOW_LIST_PAGE_SIZE, page_cursor)
+        return (profile_user, users, next_cursor), list_tags(users)
+
+    def list_tags(users):
+        return [f"user:{user_id}"] + [f"user:{user['id']}" for user in users]
+
+    list_key = ("follow-list", user_id, list_name, cursor)
+    profile_user, users, next_cursor = await get_or_build(list_key, build_list)
+
+    if format == "json":
+        return JSONResponse(content={"users": users, "next_cursor": next_cursor})
+
+    async def build_page():
+        # Follow buttons depend on who the viewer follows, so pages are cached per viewer
+        followed_ids = await run_db(get_followed_ids, current_user["id"], [user["id"] for user in users])
+        template_name, users_key = ("followers.html", "followers") if list_name == "followers" else ("following.html", "following_users")
+        html = render_page(
+            template_name,
+            {
+                "request": request,
+                "profile_user": profile_user,
+                users_key: users,
+                "followed_ids": followed_ids,
+                "next_cursor": next_cursor,
+                "current_user": current_user
+            }
+        )
+        return html, list_tags(users) + [f"viewer:{current_user['id']}"]
+
+    return HTMLResponse(await get_or_build(list_key + (current_user["id"],), build_page))
+
 @app.get("/followers/{user_id}")
 async def show_followers(
     request: Request,
     user_id: str,
+    cursor: Optional[str] = Query(None),
+    format: str = Query("html"),
     current_user = Depends(get_current_user)
 ):
-    """Show followers of a user - requires authentication"""
+    """Show followers of a user, one page at a time - requires authentication"""
     # If user is not authenticated, redirect to login page
     if not current_user:
         return RedirectResponse(url="/login", status_code=302)
     
-    profile_user = get_user_by_id(user_id)
-    follower_ids = profile_user.get("followers", [])
-    
-    # Fetch complete user objects for all followers
-    followers = []
-    for follower_id in follower_ids:
-        try:
-            follower = get_user_by_id(follower_id)
-            followers.append(follower)
-        except HTTPException:
-            # Skip if user not found
-            continue
-    
-    # Sort followers by most recent first (based on when they followed)
-    # Since we don't track the follow date, we'll just use alphabetical for now
-    followers = sorted(followers, key=lambda x: x.get("name", "").lower())
-    
-    return templates.TemplateResponse(
-        "followers.html",
-        {
-            "request": request,
-            "profile_user": profile_user,
-            "followers": followers,
-            "current_user": current_user
-        }
-    )
+    return await render_follow_list(request, user_id, "followers", cursor, format, current_user)
 
 @app.get("/following/{user_id}")
 async def show_following(
     request: Request,
     user_id: str,
+    cursor: Optional[str] = Query(None),
+    format: str = Query("html"),
     current_user = Depends(get_current_user)
 ):
-    """Show users that a user is following - requires authentication"""
+    """Show users that a user is following, one page at a time - requires authentication"""
     # If user is not authenticated, redirect to login page
     if not current_user:
         return RedirectResponse(url="/login", status_code=302)
     
-    profile_user = get_user_by_id(user_id)
-    following_ids = profile_user.get("following", [])
-    
-    # Fetch complete user objects for all following
-    following_users = []
-    for following_id in following_ids:
-        try:
-            following_user = get_user_by_id(following_id)
-            following_users.append(following_user)
-        except HTTPException:
-            # Skip if user not found
-            continue
-    
-    # Sort by name for now (since we don't track follow date)
-    following_users = sorted(following_users, key=lambda x: x.get("name", "").lower())
-    
-    return templates.TemplateResponse(
-        "following.html",
-        {
-            "request": request,
-            "profile_user": profile_user,
-            "following_users": following_users,
-            "current_user": current_user
-        }
-    )
+    return await render_follow_list(request, user_id, "following", cursor, format, current_user)
 
 @app.get("/search")
 async def search_users(
@@ -672,29 +2881,17 @@ async def search_users(
     query: Optional[str] = Query(None),
     current_user = Depends(get_current_user)
 ):
-    """Search for users by profile name"""
+    """Search for users by profile name or username prefix"""
     # If user is not authenticated, redirect to login page
     if not current_user:
         return RedirectResponse(url="/login", status_code=302)
     
-    search_results = []
-    
     if query:
-        # Query Firestore for users whose name starts with the query
-        users_ref = firestore_db.collection("users")
-        results = users_ref.stream()
-        
-        # Filter results where name starts with query (case insensitive)
-        query_lower = query.lower()
-        for user in results:
-            user_data = user.to_dict()
-            user_data["id"] = user.id
-            
-            if user_data.get("name", "").lower().startswith(query_lower):
-                search_results.append(user_data)
-        
-        # Sort results alphabetically
-        search_results = sorted(search_results, key=lambda x: x.get("name", "").lower())
+        enforce_rate_limit("search", current_user["id"])
+    search_results = await search_users_by_prefix(query)
+
+    # Look up which results the current user already follows
+    followed_ids = await run_db(get_followed_ids, current_user["id"], [user["id"] for user in search_results])
     
     return templates.TemplateResponse(
         "search.html",
@@ -703,7 +2900,8 @@ async def search_users(
             "user_id": current_user["id"],
             "current_user": current_user,
             "query": query,
-            "search_results": search_results
+            "search_results": search_results,
+            "followed_ids": followed_ids
         }
     )
 @app.post("/add-comment/{post_id}")
@@ -711,19 +2909,21 @@ async def add_comment(
     request: Request,
     post_id: str,
     comment_text: str = Form(...),
+    format: Optional[str] = Query(None),
     current_user = Depends(get_required_user)
 ):
-    """Add a comment to a post"""
+    """Add a comment to a post
+
+    Forms get a redirect back to the referring page. Scripts can ask for
+    format=json or format=html (the rendered comment) instead.
+    """
+    enforce_rate_limit("add-comment", current_user["id"])
+
     # Validate comment length
     if len(comment_text) > 200:
         raise HTTPException(status_code=400, detail="Comment too long, maximum 200 characters")
     
-    # Get the post
     post_ref = firestore_db.collection("posts").document(post_id)
-    post = post_ref.get()
-    
-    if not post.exists:
-        raise HTTPException(status_code=404, detail="Post not found")
     
     # Create comment object
     comment = {
@@ -733,16 +2933,258 @@ async def add_comment(
         "date": datetime.utcnow().isoformat()
     }
     
-    # Add comment to the post
-    post_ref.update({
-        "comments": firestore.ArrayUnion([comment])
-    })
-    
+    # Add comment to the post's comments and update its count and preview
+    comment, comment_count = await run_db(add_comment_in_transaction, firestore_db.transaction(), post_ref, comment)
+    invalidate_cached(f"post:{post_id}")
+    record_engagement(post_id, "comment")
+
+    # Push the comment to everyone watching the post
+    comment_html = render_page("_comments.html", {"comments": [comment]})
+    event_broker.publish(
+        [f"post:{post_id}"], "comment",
+        {"post_id": post_id, "comment": comment, "comment_count": comment_count, "html": comment_html}
+    )
+
+    if format == "json":
+        return JSONResponse(content={"success": True, "comment": comment, "comment_count": comment_count})
+    if format == "html":
+        return HTMLResponse(comment_html, headers={"X-Comment-Count": str(comment_count)})
+
     # Redirect back to the page where the comment was made
     referer = request.headers.get("referer", "/")
     return RedirectResponse(url=referer, status_code=302)
 
-# Add this at the end of your file to run the app with Uvicorn when the script is executed directly
+@app.post("/like/{post_id}")
+async def like_post(post_id: str, current_user = Depends(get_required_user)):
+    """Like a post - requires authentication"""
+    enforce_rate_limit("like", current_user["id"])
+    changed = await run_db(set_like, post_id, current_user["id"], True)
+    invalidate_cached(f"viewer:{current_user['id']}")
+    return JSONResponse(content={"success": True, "liked": True, "changed": changed})
+
+@app.post("/unlike/{post_id}")
+async def unlike_post(post_id: str, current_user = Depends(get_required_user)):
+    """Remove a like from a post - requires authentication"""
+    enforce_rate_limit("like", current_user["id"])
+    changed = await run_db(set_like, post_id, current_user["id"], False)
+    invalidate_cached(f"viewer:{current_user['id']}")
+    return JSONResponse(content={"success": True, "liked": False, "changed": changed})
+
+@app.get("/posts/{post_id}/comments")
+async def load_comments_page(
+    request: Request,
+    post_id: str,
+    cursor: Optional[str] = Query(None),
+    format: str = Query("json"),
+    current_user = Depends(get_required_user)
+):
+    """Older comments of a post as JSON, or as an HTML fragment with format=html"""
+    comments = await run_db(get_comments_page, post_id, COMMENT_PAGE_SIZE, decode_cursor(cursor))
+    next_cursor = next_cursor_for(comments, COMMENT_PAGE_SIZE)
+
+    if format == "html":
+        # Fragments are inserted above the comments already shown, so render oldest first
+        return templates.TemplateResponse(
+            "_comments.html",
+            {"request": request, "comments": list(reversed(comments))},
+            headers={"X-Next-Cursor": next_cursor or ""}
+        )
+    return JSONResponse(content=jsonable_encoder({"comments": comments, "next_cursor": next_cursor}))
+
+@app.get("/api/v1/feed")
+async def api_feed(
+    request: Request,
+    cursor: Optional[str] = Query(None),
+    limit: int = Query(FEED_PAGE_SIZE, ge=1, le=API_MAX_PAGE_SIZE),
+    fields: Optional[str] = Query(None),
+    current_user = Depends(get_required_user)
+):
+    """One page of the signed-in user's home feed"""
+    user_id = current_user["id"]
+    post_fields = parse_api_fields(fields, API_POST_FIELDS, API_POST_DEFAULT_FIELDS)
+    await request_timeline_backfill(current_user)
+
+    async def build():
+        # Feeds are merged and paged by date, so it is always read
+        posts = await run_db(get_timeline_posts, current_user, limit, decode_cursor(cursor), post_read_fields(post_fields, "date", "user_id"))
+        high_fanout_ids = await run_db(get_high_fanout_user_ids)
+        await fill_author_names(posts, post_fields)
+        body = api_body({"posts": [project(post, post_fields) for post in posts], "next_cursor": next_cursor_for(posts, limit)})
+        tags = [f"feed:{user_id}"] + post_tags(posts) + [f"posts:{author_id}" for author_id in high_fanout_ids]
+        return body, tags
+
+    key = ("api-feed", user_id, cursor, limit, tuple(post_fields))
+    return api_response(request, await get_or_build(key, build))
+
+@app.get("/api/v1/users/{user_id}")
+async def api_user(
+    request: Request,
+    user_id: str,
+    fields: Optional[str] = Query(None),
+    current_user = Depends(get_required_user)
+):
+    """A user's profile; is_following says whether the signed-in user follows them"""
+    viewer_id = current_user["id"]
+    user_fields = parse_api_fields(fields, API_USER_FIELDS, API_USER_DEFAULT_FIELDS)
+
+    async def build():
+        user = await get_api_user(user_id, user_fields)
+        tags = [f"user:{user_id}"]
+        if "is_following" in user_fields:
+            user["is_following"] = await run_db(is_following, viewer_id, user_id)
+            tags.append(f"viewer:{viewer_id}")
+        return api_body(project(user, user_fields)), tags
+
+    key = ("api-user", user_id, tuple(user_fields)) + ((viewer_id,) if "is_following" in user_fields else ())
+    return api_response(request, await get_or_build(key, build))
+
+@app.get("/api/v1/users/{user_id}/posts")
+async def api_user_posts(
+    request: Request,
+    user_id: str,
+    cursor: Optional[str] = Query(None),
+    limit: int = Query(PROFILE_PAGE_SIZE, ge=1, le=API_MAX_PAGE_SIZE),
+    fields: Optional[str] = Query(None),
+    current_user = Depends(get_required_user)
+):
+    """One page of a user's posts, newest first"""
+    post_fields = parse_api_fields(fields, API_POST_FIELDS, API_POST_DEFAULT_FIELDS)
+
+    async def build():
+        posts = await run_db(get_profile_posts, user_id, limit, decode_cursor(cursor), post_read_fields(post_fields, "date"))
+        await fill_author_names(posts, post_fields)
+        body = api_body({"posts": [project(post, post_fields) for post in posts], "next_cursor": next_cursor_for(posts, limit)})
+        return body, [f"posts:{user_id}", f"user:{user_id}"] + post_tags(posts)
+
+    key = ("api-user-posts", user_id, cursor, limit, tuple(post_fields))
+    return api_response(request, await get_or_build(key, build))
+
+@app.get("/api/v1/posts/{post_id}")
+async def api_post(
+    request: Request,
+    post_id: str,
+    fields: Optional[str] = Query(None),
+    current_user = Depends(get_required_user)
+):
+    """A single post"""
+    post_fields = parse_api_fields(fields, API_POST_FIELDS, API_POST_DEFAULT_FIELDS)
+
+    async def build():
+        post_ref = firestore_db.collection("posts").document(post_id)
+        post_doc = await run_db(post_ref.get, field_paths=post_read_fields(post_fields))
+        if not post_doc.exists:
+            raise HTTPException(status_code=404, detail="Post not found")
+        post = {**post_doc.to_dict(), "id": post_id}
+        await fill_author_names([post], post_fields)
+        return api_body(project(post, post_fields)), post_tags([post])
+
+    key = ("api-post", post_id, tuple(post_fields))
+    return api_response(request, await get_or_build(key, build))
+
+@app.get("/api/v1/explore")
+async def api_explore(
+    request: Request,
+    limit: int = Query(TRENDING_PAGE_SIZE, ge=1, le=API_MAX_PAGE_SIZE),
+    fields: Optional[str] = Query(None),
+    current_user = Depends(get_required_user)
+):
+    """Trending posts, highest time-decayed engagement first"""
+    post_fields = parse_api_fields(fields, API_POST_FIELDS, API_POST_DEFAULT_FIELDS)
+
+    async def build():
+        posts = await run_db(get_trending_posts, limit, post_read_fields(post_fields))
+        await fill_author_names(posts, post_fields)
+        return api_body({"posts": [project(post, post_fields) for post in posts]}), ["trending"] + post_tags(posts)
+
+    key = ("api-explore", limit, tuple(post_fields))
+    return api_response(request, await get_or_build(key, build))
+
+async def api_follow_list(request: Request, user_id: str, list_name: str, cursor: Optional[str], fields: Optional[str]):
+    """One page of a user's followers or following as JSON"""
+    user_fields = parse_api_fields(fields, USER_SUMMARY_FIELDS, API_USER_DEFAULT_FIELDS)
+    _, _, sort_field = FOLLOW_LIST_FIELDS[list_name]
+
+    async def build():
+        await get_api_user(user_id, [])
+        users, next_cursor = await run_db(
+            get_follow_list_page, user_id, list_name, FOLLOW_LIST_PAGE_SIZE, decode_cursor(cursor, sort_field)
+        )
+        body = api_body({"users": [project(user, user_fields) for user in users], "next_cursor": next_cursor})
+        return body, [f"user:{user_id}"] + [f"user:{user['id']}" for user in users]
+
+    key = ("api-follow-list", user_id, list_name, cursor, tuple(user_fields))
+    return api_response(request, await get_or_build(key, build))
+
+@app.get("/api/v1/users/{user_id}/followers")
+async def api_followers(
+    request: Request,
+    user_id: str,
+    cursor: Optional[str] = Query(None),
+    fields: Optional[str] = Query(None),
+    current_user = Depends(get_required_user)
+):
+    """One page of a user's followers, ordered by name"""
+    return await api_follow_list(request, user_id, "followers", cursor, fields)
+
+@app.get("/api/v1/users/{user_id}/following")
+async def api_following(
+    request: Request,
+    user_id: str,
+    cursor: Optional[str] = Query(None),
+    fields: Optional[str] = Query(None),
+    current_user = Depends(get_required_user)
+):
+    """One page of the users a user follows, ordered by name"""
+    return await api_follow_list(request, user_id, "following", cursor, fields)
+
+@app.get("/api/v1/search")
+async def api_search(
+    request: Request,
+    q: str = Query(..., min_length=1),
+    fields: Optional[str] = Query(None),
+    current_user = Depends(get_required_user)
+):
+    """Users whose name or username starts with q"""
+    user_fields = parse_api_fields(fields, USER_SUMMARY_FIELDS, API_USER_DEFAULT_FIELDS)
+    enforce_rate_limit("search", current_user["id"])
+    users = await search_users_by_prefix(q)
+    return api_response(request, api_body({"users": [project(user, user_fields) for user in users]}))
+
+@app.get("/events")
+async def stream_events(
+    posts: Optional[str] = Query(None),
+    current_user = Depends(get_required_user)
+):
+    """Server-sent events for the signed-in user
+
+    Streams "post" events for new posts in their feed, "follow" events for new
+    followers and "comment" events for new comments on the comma-separated
+    posts given (at most EVENT_MAX_POSTS).
+    """
+    user_id = current_user["id"]
+    post_ids = [post_id for post_id in (posts or "").split(",") if post_id][:EVENT_MAX_POSTS]
+
+    # Posts by fan-out-on-read authors reach nobody's timeline, so watch those authors directly
+    high_fanout_ids = await run_db(get_high_fanout_user_ids)
+    followed_authors = await run_db(get_followed_ids, user_id, high_fanout_ids)
+
+    topics = [f"feed:{user_id}", f"user:{user_id}"]
+    topics += [f"author:{author_id}" for author_id in followed_authors]
+    topics += [f"post:{post_id}" for post_id in post_ids]
+    return StreamingResponse(
+        event_stream(topics),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+@app.get("/metrics")
+async def serve_metrics():
+    """Request, Firestore and rendering metrics in the Prometheus text format"""
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+# Add this at the end of your file to run the app with Uvicorn when the script is executed directly.
+# Spawned processes (image workers, the reloader's server) re-run the __main__
+# script on start, so hand over to "python -m uvicorn" rather than calling
+# uvicorn.run() here; their __main__ is then uvicorn's, not this file.
 if __name__ == "__main__":
-    import uvicorn
-    uvicorn.run("main:app", host="127.0.0.1", port=8000, reload=True)
\ No newline at end of file
+    os.execv(sys.executable, [sys.executable, "-m", "uvicorn", "main:app", "--host", "127.0.0.1", "--port", "8000", "--reload"])
\ No newline at end of file
@@ -0,0 +1,166 @@
+"""Object storage for uploaded images.
+
+Blobs are addressed by name (the content hash plus an extension, see main.py).
+LocalStorage keeps them on this machine's disk and lets the app serve them;
+GCSStorage keeps them in a Cloud Storage bucket and hands browsers signed URLs
+so the bytes never pass through the app. Every method blocks, so callers run
+them on a worker thread.
+"""
+import abc
+import os
+import shutil
+import threading
+import time
+from collections import OrderedDict
+from datetime import timedelta
+from typing import Optional
+from urllib.parse import quote
+
+from google.api_core.exceptions import PreconditionFailed
+from google.api_core.retry import Retry
+from google.auth.credentials import AnonymousCredentials
+from google.cloud import storage as gcs
+
+# Resumable uploads send the file in chunks of this size (a multiple of 256 KiB)
+GCS_UPLOAD_CHUNK_SIZE = 1024 * 1024
+GCS_UPLOAD_RETRY = Retry(initial=0.5, maximum=8.0, timeout=120.0)
+SIGNED_URL_CACHE_MAX_ENTRIES = 10000
+
+
+class StorageBackend(abc.ABC):
+    """Where uploaded blobs are kept"""
+
+    # Directory new uploads are staged in before put() (None for the system temp dir)
+    staging_dir: Optional[str] = None
+
+    @abc.abstractmethod
+    def exists(self, name: str) -> bool:
+        """Whether a blob with this name is stored"""
+
+    @abc.abstractmethod
+    def put(self, source_path: str, name: str, content_type: str):
+        """Store the file at source_path as name, consuming the file
+
+        Storing a name that already exists is a no-op, since equal names mean
+        equal content.
+        """
+
+    @abc.abstractmethod
+    def fetch(self, name: str, directory: str) -> str:
+        """Return a local path holding the blob, downloading it into directory if needed"""
+
+    def local_path(self, name: str) -> Optional[str]:
+        """Path the app can serve the blob from, or None if browsers fetch it elsewhere"""
+        return None
+
+    def download_url(self, name: str) -> Optional[str]:
+        """URL browsers can fetch the blob from directly, or None if the app serves it"""
+        return None
+
+
+class LocalStorage(StorageBackend):
+    """Blobs on the local filesystem, sharded by the first two characters of their name"""
+
+    def __init__(self, root: str):
+        self.root = root
+        self.staging_dir = root
+        os.makedirs(root, exist_ok=True)
+
+    def path(self, name: str) -> str:
+        return os.path.join(self.root, name[:2], name)
+
+    def exists(self, name: str) -> bool:
+        return os.path.exists(self.path(name))
+
+    def put(self, source_path: str, name: str, content_type: str):
+        path = self.path(name)
+        if os.path.exists(path):
+            os.remove(source_path)
+            return
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if os.path.dirname(os.path.abspath(source_path)) == os.path.abspath(self.root):
+            os.replace(source_path, path)
+        else:
+            # Copy next to the destination first so the final rename stays atomic
+            temp_path = f"{path}.tmp"
+            shutil.move(source_path, temp_path)
+            os.replace(temp_path, path)
+
+    def fetch(self, name: str, directory: str) -> str:
+        return self.path(name)
+
+    def local_path(self, name: str) -> Optional[str]:
+        path = self.path(name)
+        return path if os.path.isfile(path) else None
+
+
+class GCSStorage(StorageBackend):
+    """Blobs in a Cloud Storage bucket, read through V4 signed URLs
+
+    Uploads are resumable: files are sent in GCS_UPLOAD_CHUNK_SIZE chunks and a
+    failed chunk is retried from the last one the server acknowledged. When
+    STORAGE_EMULATOR_HOST points at a local fake-GCS server, the client talks to
+    it anonymously and reads use plain emulator URLs, since there is no key to
+    sign with.
+    """
+
+    def __init__(self, bucket_name: str, client: Optional[gcs.Client] = None,
+                 signed_url_ttl: int = 3600, cache_control: Optional[str] = None):
+        self.emulator_host = os.environ.get("STORAGE_EMULATOR_HOST")
+        if client is None:
+            if self.emulator_host:
+                client = gcs.Client(project="local", credentials=AnonymousCredentials())
+            else:
+                client = gcs.Client()
+        self.client = client
+        self.bucket = client.bucket(bucket_name)
+        self.signed_url_ttl = signed_url_ttl
+        self.cache_control = cache_control
+        self._signed_urls = OrderedDict()
+        self._signed_urls_lock = threading.Lock()
+
+    def exists(self, name: str) -> bool:
+        return self.bucket.blob(name).exists()
+
+    def put(self, source_path: str, name: str, content_type: str):
+        try:
+            if self.exists(name):
+                return
+            blob = self.bucket.blob(name, chunk_size=GCS_UPLOAD_CHUNK_SIZE)
+            blob.cache_control = self.cache_control
+            # if_generation_match=0 only creates the object, which also makes retries safe
+            blob.upload_from_filename(
+                source_path, content_type=content_type, if_generation_match=0, retry=GCS_UPLOAD_RETRY
+            )
+        except PreconditionFailed:
+            pass  # Another upload of the same content won the race
+        finally:
+            if os.path.exists(source_path):
+                os.remove(source_path)
+
+    def fetch(self, name: str, directory: str) -> str:
+        path = os.path.join(directory, name)
+        self.bucket.blob(name).download_to_filename(path)
+        return path
+
+    def download_url(self, name: str) -> Optional[str]:
+        if self.emulator_host:
+            return f"{self.emulator_host.rstrip('/')}/{self.bucket.name}/{quote(name)}"
+
+        # Signing is local but not free, so reuse a URL until half its lifetime is gone
+        now = time.time()
+        with self._signed_urls_lock:
+            cached = self._signed_urls.get(name)
+            if cached and cached[1] - now > self.signed_url_ttl / 2:
+                self._signed_urls.move_to_end(name)
+                return cached[0]
+
+        url = self.bucket.blob(name).generate_signed_url(
+            version="v4", expiration=timedelta(seconds=self.signed_url_ttl), method="GET"
+        )
+        with self._signed_urls_lock:
+            self._signed_urls[name] = (url, now + self.signed_url_ttl)
+            self._signed_urls.move_to_end(name)
+            while len(self._signed_urls) > SIGNED_URL_CACHE_MAX_ENTRIES:
+                self._signed_urls.popitem(last=False)
+        return url